@@ -2,8 +2,15 @@
 A mock for Redis.
 This mock only works with the redis-py library.
 
-Note: This module is not thread safe
-Currently only a few Redis sorted set commands are supported (ZADD, ZRANGE, ZRANGEBYSCORE, ZREVRANGE, ZREVRANGEBYSCORE)
+Note: Commands are run one at a time under a single lock, and each thread is treated as its own connection
+Currently only a few Redis commands are supported:
+Sorted sets: ZADD, ZRANGE, ZRANGEBYSCORE, ZREVRANGE, ZREVRANGEBYSCORE, ZRANGEBYLEX, ZREVRANGEBYLEX, ZLEXCOUNT,
+ZREMRANGEBYLEX
+Sets: SADD, SISMEMBER, SMEMBERS, SCARD, SDIFF
+Bitmaps: SETBIT, GETBIT, BITCOUNT, BITPOS, BITOP, BITFIELD
+HyperLogLogs: PFADD, PFCOUNT, PFMERGE
+Streams: XADD, XLEN, XTRIM, XRANGE, XREVRANGE, XREAD, XREADGROUP, XGROUP (CREATE, DESTROY), XACK, XPENDING
+Transactions: WATCH, UNWATCH, MULTI, EXEC, DISCARD
 I will be adding more commands in the future.
 If you want more commands added, send me a message via github (username: dhui).
 
@@ -36,20 +43,133 @@ class TestSuite(unittest.TestCase):
         mock_execute_command.side_effect = redis_mock.execute_command
 
 
+Sharing the mock between processes:
+
+By default, every process has its own private RedisMock db. To share a single db between processes
+(e.g. pytest-xdist or multiprocessing workers), start a RedisMockServer in one process:
+server = redis_mock.RedisMockServer().start()
+
+Then in each worker process, use a RedisMockClient connected to the server's Unix socket address:
+client = redis_mock.RedisMockClient(server.address)
+mock_execute_command.side_effect = client.execute_command
+
+Use client.flush_db() instead of redis_mock.flush_db() to flush the shared db.
+Multiple commands can be sent in a single round trip with client.execute_batch([(args, options), ...])
+Call server.stop() when you're done.
+
+
+Transactions:
+
+WATCH, MULTI, EXEC and DISCARD have to be sent as raw commands, e.g.
+while True:
+    redis_c.execute_command("WATCH", "mykey")
+    next_score = len(redis_c.zrange("mykey", 0, -1))
+    redis_c.execute_command("MULTI")
+    redis_c.zadd("mykey", "member%s" % next_score, next_score)
+    if redis_c.execute_command("EXEC") is not None:
+        break
+
+redis-py's pipelines (redis_c.pipeline(), pipe.watch(), pipe.multi(), pipe.execute()) and redis_c.transaction()
+are not supported, since they don't go through Redis.execute_command and will try to connect to a real server.
+redis_mock.flush_db() also discards the calling thread's transaction and watched keys.
+
+
+Streaming large ranges:
+
+ZRANGE, ZREVRANGE, ZRANGEBYSCORE, ZREVRANGEBYSCORE, ZRANGEBYLEX and ZREVRANGEBYLEX return a list by default.
+Pass stream=True to get a generator that fetches the members (or (member, score) pairs) from the sorted set in chunks
+instead, e.g.
+for member, score in redis_c.execute_command("ZRANGE", "mykey", 0, -1, withscores=True, stream=True):
+
+
+Simulating the network:
+
+By default every command is answered instantly and never fails. To add latency and failures, set a NetworkModel:
+redis_mock.set_network_model(redis_mock.NetworkModel(
+    latencies={"ZRANGE": redis_mock.PercentileLatency({50: 0.001, 99: 0.02, 100: 0.25})},
+    default_latency=redis_mock.NormalLatency(0.001, 0.0002), round_trip=0.0005,
+    timeout=0.1, timeout_rate=0.001, connection_error_rate=0.0001, seed=42))
+
+The delays are slept on a VirtualClock by default, so they take no real time. Each thread has its own virtual time,
+so concurrent clients overlap instead of adding up. After joining them, model.clock.time() in the thread that created
+the model tells how long they took. Use model.clock.sleep() in your own retry back off to keep it virtual too.
+Blocking stream reads (XREAD and XREADGROUP with BLOCK) always wait in real time, since there's no telling when
+another thread will write. With a VirtualClock, the time they spent blocked is added to the reader's virtual time.
+Call redis_mock.set_network_model(None) to turn it off again.
+
+
+Persistence:
+
+The RedisMock db can be persisted to an append only file, which is replayed when it's enabled again:
+redis_mock.enable_aof("/path/to/redis_mock.aof", appendfsync="everysec")
+
+appendfsync is one of "always", "everysec" or "no", like Redis's appendfsync setting.
+redis_mock.rewrite_aof() compacts the file in a background thread, and redis_mock.disable_aof() flushes and closes it.
+
+
 """
 
+import binascii
+import bisect
+import cPickle
+import cStringIO
+import math
+import multiprocessing
+import multiprocessing.connection
+import operator
+import os
+import random
+import re
+import struct
+import tempfile
+import threading
+import time
 import types
+import zlib
+
+import redis.exceptions
 
 ScoreTypes = (types.IntType, types.LongType, types.FloatType)
 
+# Commands that modify the db, and so are logged to the append only file
+WriteCommands = set(["ZADD", "ZREMRANGEBYLEX", "SADD", "SETBIT", "BITOP", "BITFIELD", "XADD", "XTRIM", "XREADGROUP",
+                     "XGROUP", "XACK", "PFADD", "PFMERGE"])
+
+AppendFsyncPolicies = ("always", "everysec", "no")
+
 
 class RedisSortedSetMock:
     """
     Mocks Redis Sorted Sets
     """
 
+    # The number of members fetched at a time when streaming a range
+    STREAM_CHUNK_SIZE = 1000
+    # Moving a changed member into place in the ordered lists costs a bisect plus shifting the rest of the lists
+    # along, while sorting the whole sorted set again costs n log n comparisons. These are their relative costs
+    # (in the time it takes to shift one entry of the lists), measured so that whichever is quicker gets used.
+    REORDER_FIND_COST = 3000
+    REORDER_COMPARE_COST = 70
+
     def __init__(self):
         self.dict = {}
+        # The members ordered by (score, member), like Redis's skiplist. The scores and members are kept in
+        # separate lists (instead of a list of tuples) so that ranges can be bisected by score without
+        # allocating a tuple per member.
+        self.scores = []
+        self.members = []
+        # Inserting into the ordered lists is O(n), so ZADD only updates the dict and records the change here,
+        # and the ordered lists are brought up to date by the next command that reads them.
+        # member -> its score in the ordered lists (as a float), or None if it isn't in them
+        self.changed = {}
+
+    def __find(self, score, member):
+        """
+        Helper function to find the index that (score, member) is at, or should be inserted at, in the ordered lists
+        """
+        lo = bisect.bisect_left(self.scores, score)
+        hi = bisect.bisect_right(self.scores, score, lo)
+        return bisect.bisect_left(self.members, member, lo, hi)
 
     def add(self, *args):
         """
@@ -58,16 +178,27 @@ class RedisSortedSetMock:
         if len(args) < 2:
             raise Exception("You need to specify member and score when adding to a Redis sorted set. args: %s" % args)
 
-        ret = []
-        # go through the arguments 2 at a time
-        for score, member in zip(args[0::2], args[1::2]):
+        if len(args) % 2 != 0:
+            raise Exception("syntax error: every member added to a Redis sorted set needs a score. args: %s" % (args,))
+        pairs = zip(args[0::2], args[1::2])
+        # check all the pairs before adding any, so a bad pair doesn't leave the earlier ones half added
+        for score, member in pairs:
             if not isinstance(member, types.StringTypes):
                 raise Exception("Redis sorted set member must be a string")
             if not isinstance(score, ScoreTypes):
                 raise Exception("Redis sorted set score must be an integer or float")
+
+        ret = []
+        # go through the arguments 2 at a time
+        for score, member in pairs:
             local_ret = True
             if member in self.dict:
                 local_ret = False
+            if member not in self.changed:
+                if local_ret:
+                    self.changed[member] = None
+                else:
+                    self.changed[member] = float(self.dict[member])
             self.dict[member] = score
             ret.append(local_ret)
 
@@ -76,46 +207,115 @@ class RedisSortedSetMock:
             ret = ret[0]
         return ret
 
-    def __get_sorted_by_score(self, reverse=False):
+    @classmethod
+    def max_changes_to_reorder(cls, length):
+        """
+        Returns how many changed members of a sorted set of length members are quicker to move into place
+        one at a time than to sort the whole sorted set again
+        """
+        if length < 2:
+            return 0
+        sort_cost = cls.REORDER_COMPARE_COST * length * math.log(length, 2)
+        return int(sort_cost / (cls.REORDER_FIND_COST + length))
+
+    def __reorder(self):
         """
-        Helper function to sort the internal dictionary by the score
+        Helper function to bring the ordered lists up to date with the changes made since they were last used
         """
-        all_items = [(key, float(value)) for key, value in self.dict.iteritems()]
-        all_items.sort(key=lambda x: x[1], reverse=reverse)  # sort by score
-        return all_items
+        if not self.changed:
+            return
+        if len(self.changed) > self.max_changes_to_reorder(len(self.members)):
+            items = sorted((float(score), member) for member, score in self.dict.iteritems())
+            self.scores = [score for score, member in items]
+            self.members = [member for score, member in items]
+        else:
+            for member, old_score in self.changed.iteritems():
+                if old_score is not None:
+                    index = self.__find(old_score, member)
+                    del self.scores[index]
+                    del self.members[index]
+                if member in self.dict:
+                    score = float(self.dict[member])
+                    index = self.__find(score, member)
+                    self.scores.insert(index, score)
+                    self.members.insert(index, member)
+        self.changed = {}
+
+    def __iter_items(self, lo, hi, withscores, score_cast_func, reverse):
+        """
+        Helper function to iterate over the members between the indexes lo and hi (exclusive) of the ordered lists,
+        a chunk at a time
+        """
+        chunk_size = self.STREAM_CHUNK_SIZE
+        if reverse:
+            chunk_starts = xrange(hi, lo, -chunk_size)
+        else:
+            chunk_starts = xrange(lo, hi, chunk_size)
+        for chunk_start in chunk_starts:
+            if reverse:
+                chunk_lo, chunk_hi = max(lo, chunk_start - chunk_size), chunk_start
+            else:
+                chunk_lo, chunk_hi = chunk_start, min(hi, chunk_start + chunk_size)
+            members = self.members[chunk_lo:chunk_hi]
+            if withscores:
+                items = zip(members, map(score_cast_func, self.scores[chunk_lo:chunk_hi]))
+            else:
+                items = members
+            if reverse:
+                items.reverse()
+            for item in items:
+                yield item
 
-    def range(self, start, end, withscores=False, reverse=False):
+    def __get_items(self, lo, hi, withscores, score_cast_func, reverse, stream):
+        """
+        Helper function to get the members between the indexes lo and hi (exclusive) of the ordered lists,
+        either as a list or as a generator if stream is True
+        """
+        lo = max(lo, 0)
+        hi = min(hi, len(self.members))
+        if hi < lo:
+            hi = lo
+        items = self.__iter_items(lo, hi, withscores, score_cast_func, reverse)
+        if stream:
+            return items
+        return list(items)
+
+    def range(self, start, end, withscores=False, reverse=False, score_cast_func=float, stream=False):
         """
         Performs the same functionality as ZRANGE and ZREVRANGE
+
+        If stream is True, a generator is returned instead of a list. The members (or (member, score) pairs)
+        are fetched from the sorted set in chunks as the generator is iterated, so that a large range is never
+        fully copied. The sorted set shouldn't be modified while the generator is in use.
         """
+        self.__reorder()
         # The way Redis sorted sets range works is slightly different for slices so it's not a direct translation.
-        all_items = self.__get_sorted_by_score(reverse=reverse)
+        length = len(self.members)
+        lo, hi = 0, 0
         if start >= 0 and end >= 0:
-            end += 1
-            all_items = all_items[start:end]
+            lo, hi = start, end + 1
         if start < 0 and end < 0:
             # both negative
             range_size = end - start
-            if range_size < 0:
-                return []  # end is greater than start, so this is not valid
-            if abs(start) >= len(all_items):
-                return []  # the start is too negative
-            all_items = all_items[start:][:range_size + 1]
-        if start < 0 and end >= 0:
-            return []  # Redis doesn't return anything for this
+            if range_size >= 0 and abs(start) < length:
+                lo = length + start
+                hi = lo + range_size + 1
+            # otherwise end is greater than start or the start is too negative, so there's nothing to return
+        # if start < 0 and end >= 0, Redis doesn't return anything
         if start >= 0 and end < 0:
-            end = len(all_items) + end + 1 # calculate the new end index
-            if end <= start:
-                return []
-            all_items = all_items[start:end]
+            lo, hi = start, length + end + 1  # calculate the new end index
 
-        if withscores:
-            return all_items
-        return [member for member, score in all_items]
+        if reverse:
+            # the indexes count from the end of the ordered lists
+            lo, hi = length - min(hi, length), length - lo
+        return self.__get_items(lo, hi, withscores, score_cast_func, reverse, stream)
 
-    def rangebyscore(self, min, max, withscores=False, offset=None, count=None, reverse=False):
+    def rangebyscore(self, min, max, withscores=False, offset=None, count=None, reverse=False, score_cast_func=float,
+                     stream=False):
         """
         Performs the same functionality as ZRANGEBYSCORE and ZREVRANGEBYSCORE
+
+        If stream is True, a generator is returned instead of a list (see range).
         """
         min_inclusive = True
         max_inclusive = True
@@ -140,121 +340,1394 @@ class RedisSortedSetMock:
         else:
             raise Exception("max in Redis sorted set rangebyscore must be a string, integer, or float")
 
-        if min_value > max_value:
-            return []
+        self.__reorder()
+        if min_inclusive:
+            lo = bisect.bisect_left(self.scores, min_value)
+        else:
+            lo = bisect.bisect_right(self.scores, min_value)
+        if max_inclusive:
+            hi = bisect.bisect_right(self.scores, max_value, lo)
+        else:
+            hi = bisect.bisect_left(self.scores, max_value, lo)
+
+        lo, hi = self.__apply_limit(lo, hi, offset, count, reverse)
+        return self.__get_items(lo, hi, withscores, score_cast_func, reverse, stream)
+
+    def __apply_limit(self, lo, hi, offset, count, reverse):
+        """
+        Helper function to narrow the indexes lo and hi (exclusive) of a range down to its LIMIT offset and count
+        """
+        if offset is None or count is None:
+            return (lo, hi)
+        # the offset and count are from the start of the range in the order it is returned
+        if reverse:
+            hi -= offset
+            if count >= 0:
+                lo = max(lo, hi - count)
+        else:
+            lo += offset
+            if count >= 0:
+                hi = min(hi, lo + count)
+        return (lo, hi)
+
+    def __parse_lex_bound(self, bound):
+        """
+        Helper function to parse a lex range bound into (value, inclusive).
+        The value is None for - and +, which are the smallest and largest possible members.
+        """
+        if bound in ('-', '+'):
+            return (None, True)
+        if isinstance(bound, types.StringTypes) and len(bound) > 0:
+            if bound[0] == '[':
+                return (bound[1:], True)
+            if bound[0] == '(':
+                return (bound[1:], False)
+        raise Exception("min or max in Redis sorted set lex range must start with '(' or '[', or be '-' or '+'")
+
+    def __lex_range_indexes(self, min, max):
+        """
+        Helper function to get the indexes lo and hi (exclusive) of the members between min and max lexicographically
+        """
+        if max == '-' or min == '+':
+            return (0, 0)
+        min_value, min_inclusive = self.__parse_lex_bound(min)
+        max_value, max_inclusive = self.__parse_lex_bound(max)
+        self.__reorder()
+        length = len(self.members)
+        if length == 0 or self.scores[0] == self.scores[-1]:
+            # All the members have the same score, so they are ordered by member and can be bisected
+            lo, hi = 0, length
+            if min_value is not None:
+                if min_inclusive:
+                    lo = bisect.bisect_left(self.members, min_value)
+                else:
+                    lo = bisect.bisect_right(self.members, min_value)
+            if max_value is not None:
+                if max_inclusive:
+                    hi = bisect.bisect_right(self.members, max_value, lo)
+                else:
+                    hi = bisect.bisect_left(self.members, max_value, lo)
+            if hi < lo:
+                hi = lo
+            return (lo, hi)
+
+        # Like Redis, the result is unspecified when the scores differ. Walk the members in score order,
+        # from the first one that is after min until the first one that is after max.
+        def after_min(member):
+            return min_value is None or member > min_value or (min_inclusive and member == min_value)
+
+        def before_max(member):
+            return max_value is None or member < max_value or (max_inclusive and member == max_value)
+
+        lo = 0
+        while lo < length and not after_min(self.members[lo]):
+            lo += 1
+        hi = lo
+        while hi < length and before_max(self.members[hi]):
+            hi += 1
+        return (lo, hi)
+
+    def rangebylex(self, min, max, offset=None, count=None, reverse=False, stream=False):
+        """
+        Performs the same functionality as ZRANGEBYLEX and ZREVRANGEBYLEX
+
+        If stream is True, a generator is returned instead of a list (see range).
+        """
+        lo, hi = self.__lex_range_indexes(min, max)
+        lo, hi = self.__apply_limit(lo, hi, offset, count, reverse)
+        return self.__get_items(lo, hi, False, float, reverse, stream)
+
+    def lexcount(self, min, max):
+        """
+        Performs the same functionality as ZLEXCOUNT
+        """
+        lo, hi = self.__lex_range_indexes(min, max)
+        return hi - lo
+
+    def remrangebylex(self, min, max):
+        """
+        Performs the same functionality as ZREMRANGEBYLEX
+        """
+        lo, hi = self.__lex_range_indexes(min, max)
+        for member in self.members[lo:hi]:
+            del self.dict[member]
+        del self.scores[lo:hi]
+        del self.members[lo:hi]
+        return hi - lo
+
+    def __repr__(self):
+        """
+        Overwritten so you can print the sorted set
+        """
+        return str(self.dict)
+
+
+class RedisHyperLogLogMock:
+    """
+    Mocks Redis HyperLogLogs. Uses the same hash function, number of registers and estimator as Redis,
+    so the counts (and their 0.81% standard error) match what Redis would return.
+    """
+
+    P = 14  # the number of bits of the hash used to pick a register
+    REGISTERS = 1 << P
+    Q = 64 - P  # the number of bits of the hash used to count the run of zeros
+    # The registers start out sparse (a dict of only the non zero registers), and switch to dense (a bytearray
+    # with one byte per register) when Redis would: once the sparse encoding would take more than
+    # hll-sparse-max-bytes (3000 bytes by default, with up to 3 bytes per non zero register), or a register is
+    # higher than the sparse encoding can hold.
+    SPARSE_MAX_REGISTERS = 3000 / 3
+    SPARSE_MAX_VALUE = 32
+    # Every byte of a packed integer of registers with only its high bit set (see merge)
+    HIGH_BITS = int("80" * REGISTERS, 16)
+    ALPHA_INF = 0.721347520444481703680  # constant for 0.5/ln(2)
+    HASH_SEED = 0xadc83b19
+    HASH_M = 0xc6a4a7935bd1e995
+    HASH_MASK = (1 << 64) - 1
+
+    def __init__(self):
+        self.sparse = {}  # register index -> value, or None once the registers are dense
+        self.dense = None
+        self.cardinality = None  # cached result of count(), or None if the registers changed since
+
+    def __hash(self, element):
+        """
+        Helper function that implements MurmurHash64A, the hash function Redis uses for HyperLogLogs
+        """
+        m = self.HASH_M
+        mask = self.HASH_MASK
+        length = len(element)
+        h = (self.HASH_SEED ^ (length * m)) & mask
+        end = length - (length & 7)
+        for k in struct.unpack_from("<%dQ" % (end / 8), element):
+            k = (k * m) & mask
+            k ^= k >> 47
+            k = (k * m) & mask
+            h ^= k
+            h = (h * m) & mask
+        if length & 7:
+            for i in xrange(length - 1, end - 1, -1):
+                h ^= ord(element[i]) << (8 * (i - end))
+            h = (h * m) & mask
+        h ^= h >> 47
+        h = (h * m) & mask
+        h ^= h >> 47
+        return h
+
+    def __set_register(self, index, value):
+        """
+        Helper function to raise the register at index to value. Returns whether the register changed.
+        """
+        if self.sparse is not None:
+            if self.sparse.get(index, 0) >= value:
+                return False
+            self.sparse[index] = value
+            if len(self.sparse) > self.SPARSE_MAX_REGISTERS or value > self.SPARSE_MAX_VALUE:
+                self.dense = self.get_registers()
+                self.sparse = None
+        else:
+            if self.dense[index] >= value:
+                return False
+            self.dense[index] = value
+        self.cardinality = None
+        return True
+
+    def add(self, *elements):
+        """
+        Performs the same functionality as PFADD. Returns whether any register changed.
+        """
+        changed = False
+        for element in elements:
+            h = self.__hash(str(element))
+            index = h & (self.REGISTERS - 1)
+            h = (h >> self.P) | (1 << self.Q)
+            count = (h & -h).bit_length()  # the length of the run of zeros (+ 1)
+            if self.__set_register(index, count):
+                changed = True
+        return changed
+
+    def get_registers(self):
+        """
+        Returns a copy of the registers as a bytearray with one byte per register
+        """
+        if self.sparse is None:
+            return bytearray(self.dense)
+        registers = bytearray(self.REGISTERS)
+        for index, value in self.sparse.iteritems():
+            registers[index] = value
+        return registers
+
+    def merge(self, other):
+        """
+        Performs the same functionality as PFMERGE, merging other into this HyperLogLog
+        by taking the max of each register
+        """
+        if self.sparse is not None:
+            self.dense = self.get_registers()
+            self.sparse = None
+        if other.sparse is not None:
+            for index, value in other.sparse.iteritems():
+                if self.dense[index] < value:
+                    self.dense[index] = value
+        else:
+            # Take the max of every register at once, on the registers packed into integers. The registers are
+            # below 0x80, so setting each byte's high bit in one before subtracting the other never borrows from the
+            # next byte, and leaves the high bit set only in the bytes where the first register is the larger one.
+            high_bits = self.HIGH_BITS
+            registers = int(binascii.hexlify(self.dense), 16)
+            other_registers = int(binascii.hexlify(other.dense), 16)
+            larger = (((registers | high_bits) - other_registers) & high_bits) >> 7
+            larger *= 0xff  # 0xff in the bytes where the first register is the larger one, 0 elsewhere
+            registers = (registers & larger) | (other_registers & ~larger)
+            self.dense = bytearray(binascii.unhexlify("%0*x" % (2 * self.REGISTERS, registers)))
+        self.cardinality = None
+
+    @classmethod
+    def estimate(cls, registers):
+        """
+        Estimates the cardinality of the registers (a bytearray with one byte per register),
+        using the same estimator as Redis
+        """
+        m = float(cls.REGISTERS)
+        histogram = [registers.count(chr(value)) for value in xrange(cls.Q + 2)]
+        z = m * cls.__tau((m - histogram[cls.Q + 1]) / m)
+        for j in xrange(cls.Q, 0, -1):
+            z += histogram[j]
+            z *= 0.5
+        z += m * cls.__sigma(histogram[0] / m)
+        return int(round(cls.ALPHA_INF * m * m / z))
+
+    @staticmethod
+    def __sigma(x):
+        """
+        Helper function for the estimator
+        """
+        if x == 1.0:
+            return float('inf')
+        y = 1.0
+        z = x
+        while True:
+            x *= x
+            z_prime = z
+            z += x * y
+            y += y
+            if z_prime == z:
+                return z
+
+    @staticmethod
+    def __tau(x):
+        """
+        Helper function for the estimator
+        """
+        if x == 0.0 or x == 1.0:
+            return 0.0
+        y = 1.0
+        z = 1 - x
+        while True:
+            x = math.sqrt(x)
+            z_prime = z
+            y *= 0.5
+            z -= math.pow(1 - x, 2) * y
+            if z_prime == z:
+                return z / 3
+
+    def count(self):
+        """
+        Performs the same functionality as PFCOUNT on a single key. The count is cached until the registers change.
+        """
+        if self.cardinality is None:
+            if self.sparse is not None:
+                registers = self.get_registers()
+            else:
+                registers = self.dense
+            self.cardinality = self.estimate(registers)
+        return self.cardinality
+
+    def __repr__(self):
+        """
+        Overwritten so you can print the HyperLogLog
+        """
+        return "<HyperLogLog %s registers, count: %s>" % ("sparse" if self.sparse is not None else "dense", self.count())
+
+
+class RedisBitmapMock:
+    """
+    Mocks Redis strings used as bitmaps (SETBIT, GETBIT, BITCOUNT, BITPOS, BITOP, BITFIELD)
+    The bits are stored in a bytearray, most significant bit first, which grows as bits are set.
+    """
+
+    # Maps each byte to the number of bits set in it
+    POPCOUNT_TABLE = "".join(chr(bin(i).count("1")) for i in xrange(256))
+    # zlib.adler32 sums bytes modulo 65521, starting from 1, so a chunk of up to 8189 popcounts (at most 8 each)
+    # is summed exactly: 1 + 8 * 8189 = 65513
+    POPCOUNT_CHUNK_SIZE = 8189
+    NON_ZERO_BYTE = re.compile("[^\x00]")
+    NON_FF_BYTE = re.compile("[^\xff]")
+    MAX_OFFSET = 2 ** 32  # Redis strings are limited to 512MB
+
+    def __init__(self, value=None):
+        self.bytes = bytearray(value or "")
+
+    def __grow(self, length):
+        """
+        Helper function to pad the bitmap with zeros so that it's at least length bytes long
+        """
+        if len(self.bytes) < length:
+            self.bytes.extend(bytearray(length - len(self.bytes)))
+
+    def __byte_range(self, start, end):
+        """
+        Helper function to convert a start and end (inclusive, and negative from the end) byte range
+        into the indexes lo and hi (exclusive)
+        """
+        length = len(self.bytes)
+        if start < 0:
+            start = max(length + start, 0)
+        if end < 0:
+            end = max(length + end, 0)
+        hi = min(end + 1, length)
+        if start >= hi:
+            return (0, 0)
+        return (start, hi)
+
+    def __parse_offset(self, offset):
+        """
+        Helper function to parse and validate a bit offset
+        """
+        offset = int(offset)
+        if offset < 0 or offset >= self.MAX_OFFSET:
+            raise Exception("bit offset is not an integer or out of range")
+        return offset
+
+    def setbit(self, offset, value):
+        """
+        Performs the same functionality as SETBIT. Returns the bit's previous value.
+        """
+        offset = self.__parse_offset(offset)
+        value = int(value)
+        if value not in (0, 1):
+            raise Exception("bit is not an integer or out of range")
+        index = offset >> 3
+        mask = 0x80 >> (offset & 7)
+        self.__grow(index + 1)
+        old = 1 if self.bytes[index] & mask else 0
+        if value:
+            self.bytes[index] |= mask
+        else:
+            self.bytes[index] &= ~mask & 0xff
+        return old
+
+    def getbit(self, offset):
+        """
+        Performs the same functionality as GETBIT
+        """
+        offset = self.__parse_offset(offset)
+        index = offset >> 3
+        if index >= len(self.bytes):
+            return 0
+        return 1 if self.bytes[index] & (0x80 >> (offset & 7)) else 0
+
+    def bitcount(self, start=None, end=None):
+        """
+        Performs the same functionality as BITCOUNT.
+        The bytes are translated to their popcounts, which are then summed in bulk (with zlib.adler32)
+        instead of one at a time in Python.
+        """
+        if start is None and end is None:
+            lo, hi = 0, len(self.bytes)
+        elif start is None or end is None:
+            raise Exception("syntax error: BITCOUNT needs both start and end, or neither")
+        else:
+            lo, hi = self.__byte_range(int(start), int(end))
+        if lo == 0 and hi == len(self.bytes):
+            popcounts = self.bytes.translate(self.POPCOUNT_TABLE)
+        else:
+            popcounts = self.bytes[lo:hi].translate(self.POPCOUNT_TABLE)
+        count = 0
+        for i in xrange(0, len(popcounts), self.POPCOUNT_CHUNK_SIZE):
+            count += (zlib.adler32(buffer(popcounts, i, self.POPCOUNT_CHUNK_SIZE)) & 0xffff) - 1
+        return count
+
+    def bitpos(self, bit, start=None, end=None):
+        """
+        Performs the same functionality as BITPOS.
+        The first byte that isn't all 0s (or all 1s when looking for a 0) is found with a regex, instead of
+        looping over the bytes in Python.
+        """
+        bit = int(bit)
+        if bit not in (0, 1):
+            raise Exception("The bit argument must be 1 or 0.")
+        end_given = end is not None
+        if start is None:
+            start = 0
+        if end is None:
+            end = -1
+        lo, hi = self.__byte_range(int(start), int(end))
+        if lo == hi:
+            return -1
+        if bit == 1:
+            match = self.NON_ZERO_BYTE.search(self.bytes, lo, hi)
+        else:
+            match = self.NON_FF_BYTE.search(self.bytes, lo, hi)
+        if match is None:
+            if bit == 0 and not end_given:
+                # Redis treats the bits past the end of the string as 0s
+                return hi * 8
+            return -1
+        index = match.start()
+        byte = self.bytes[index]
+        if bit == 0:
+            byte ^= 0xff
+        return index * 8 + 8 - byte.bit_length()
+
+    def __get_int(self, lo, hi):
+        """
+        Helper function to read the bytes between lo and hi (exclusive) as a big endian integer.
+        Bytes past the end of the bitmap are read as 0s.
+        """
+        chunk = self.bytes[lo:hi]
+        if len(chunk) < hi - lo:
+            chunk.extend(bytearray(hi - lo - len(chunk)))
+        if not chunk:
+            return 0
+        return int(binascii.hexlify(chunk), 16)
+
+    def __set_int(self, lo, hi, value):
+        """
+        Helper function to write a big endian integer into the bytes between lo and hi (exclusive)
+        """
+        self.__grow(hi)
+        self.bytes[lo:hi] = binascii.unhexlify("%0*x" % (2 * (hi - lo), value))
+
+    @classmethod
+    def bitop(cls, operation, bitmaps):
+        """
+        Performs the same functionality as BITOP, returning the resulting bitmap.
+        The bitmaps are converted to (arbitrarily large) integers so that the operation is done in bulk.
+        Shorter bitmaps are padded with 0s.
+        """
+        operation = str(operation).upper()
+        if operation not in ("AND", "OR", "XOR", "NOT"):
+            raise Exception("syntax error")
+        if operation == "NOT" and len(bitmaps) != 1:
+            raise Exception("BITOP NOT must be called with a single source key.")
+        length = max([len(bitmap.bytes) for bitmap in bitmaps] + [0])
+        if length == 0:
+            return cls()
+        values = [bitmap.__get_int(0, length) for bitmap in bitmaps]
+        if operation == "NOT":
+            result = values[0] ^ ((1 << (8 * length)) - 1)
+        elif operation == "AND":
+            result = reduce(operator.and_, values)
+        elif operation == "OR":
+            result = reduce(operator.or_, values)
+        else:
+            result = reduce(operator.xor, values)
+        bitmap = cls()
+        bitmap.__set_int(0, length, result)
+        return bitmap
+
+    def __parse_bitfield_type(self, field_type):
+        """
+        Helper function to parse a BITFIELD type (e.g. i8 or u16) into (signed, bits)
+        """
+        field_type = str(field_type)
+        signed = field_type[:1] == "i"
+        try:
+            bits = int(field_type[1:])
+        except ValueError:
+            bits = 0
+        if field_type[:1] not in ("i", "u") or bits < 1 or (signed and bits > 64) or (not signed and bits > 63):
+            raise Exception("Invalid bitfield type. Use something like i16 u8. Note that u64 is not supported but i64 is.")
+        return (signed, bits)
+
+    def __parse_bitfield_offset(self, offset, bits):
+        """
+        Helper function to parse a BITFIELD offset. Offsets starting with # are multiplied by the type's width.
+        """
+        offset = str(offset)
+        if offset.startswith("#"):
+            return self.__parse_offset(int(offset[1:]) * bits)
+        return self.__parse_offset(offset)
+
+    def __get_field(self, offset, bits, signed):
+        """
+        Helper function to read the field of the given width at the given bit offset
+        """
+        lo = offset >> 3
+        hi = (offset + bits + 7) >> 3
+        shift = (hi - lo) * 8 - (offset & 7) - bits
+        value = (self.__get_int(lo, hi) >> shift) & ((1 << bits) - 1)
+        if signed and value >> (bits - 1):
+            value -= 1 << bits
+        return value
+
+    def __set_field(self, offset, bits, value):
+        """
+        Helper function to write the field of the given width at the given bit offset
+        """
+        lo = offset >> 3
+        hi = (offset + bits + 7) >> 3
+        shift = (hi - lo) * 8 - (offset & 7) - bits
+        mask = ((1 << bits) - 1) << shift
+        current = self.__get_int(lo, hi)
+        self.__set_int(lo, hi, (current & ~mask) | ((value << shift) & mask))
+
+    def __handle_overflow(self, value, bits, signed, overflow):
+        """
+        Helper function to apply the OVERFLOW behavior to a value that is being written.
+        Returns None if the write should fail.
+        """
+        if signed:
+            min_value, max_value = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+        else:
+            min_value, max_value = 0, (1 << bits) - 1
+        if min_value <= value <= max_value:
+            return value
+        if overflow == "FAIL":
+            return None
+        if overflow == "SAT":
+            return max_value if value > max_value else min_value
+        # WRAP
+        value &= (1 << bits) - 1
+        if signed and value >> (bits - 1):
+            value -= 1 << bits
+        return value
+
+    def bitfield(self, *args):
+        """
+        Performs the same functionality as BITFIELD, with the GET, SET, INCRBY and OVERFLOW subcommands.
+        Returns (the list of results, whether the bitmap was written to).
+        """
+        # Like Redis, parse every subcommand before running any, so a bad one doesn't leave the bitmap half written
+        operations = []  # (subcommand, signed, bits, offset, value, overflow)
+        overflow = "WRAP"
+        i = 0
+        while i < len(args):
+            subcommand = str(args[i]).upper()
+            if subcommand == "OVERFLOW" and i + 1 < len(args):
+                overflow = str(args[i + 1]).upper()
+                if overflow not in ("WRAP", "SAT", "FAIL"):
+                    raise Exception("Invalid OVERFLOW type specified")
+                i += 2
+                continue
+            if subcommand == "GET" and i + 2 < len(args):
+                signed, bits = self.__parse_bitfield_type(args[i + 1])
+                offset = self.__parse_bitfield_offset(args[i + 2], bits)
+                operations.append((subcommand, signed, bits, offset, None, overflow))
+                i += 3
+                continue
+            if subcommand in ("SET", "INCRBY") and i + 3 < len(args):
+                signed, bits = self.__parse_bitfield_type(args[i + 1])
+                offset = self.__parse_bitfield_offset(args[i + 2], bits)
+                try:
+                    value = int(args[i + 3])
+                except ValueError:
+                    raise Exception("value is not an integer or out of range")
+                operations.append((subcommand, signed, bits, offset, value, overflow))
+                i += 4
+                continue
+            raise Exception("syntax error")
+
+        ret = []
+        written = False
+        for subcommand, signed, bits, offset, value, overflow in operations:
+            old = self.__get_field(offset, bits, signed)
+            if subcommand == "GET":
+                ret.append(old)
+                continue
+            if subcommand == "INCRBY":
+                value += old
+            value = self.__handle_overflow(value, bits, signed, overflow)
+            if value is None:
+                ret.append(None)
+            else:
+                self.__set_field(offset, bits, value)
+                written = True
+                ret.append(old if subcommand == "SET" else value)
+        return (ret, written)
+
+    def __repr__(self):
+        """
+        Overwritten so you can print the bitmap
+        """
+        return repr(str(self.bytes))
+
+
+class RedisStreamConsumerGroupMock:
+    """
+    Mocks a consumer group of a Redis Stream
+    """
+
+    def __init__(self, last_delivered_id):
+        self.last_delivered_id = last_delivered_id
+        # The pending entries list: entry id -> [consumer, delivery time (ms), delivery count]
+        self.pending = {}
+        self.pending_ids = []  # the ids in self.pending, in order
+
+    def add_pending(self, entry_id, consumer, now):
+        """
+        Adds an entry that has been delivered to a consumer to the pending entries list
+        """
+        if entry_id in self.pending:
+            pending = self.pending[entry_id]
+            pending[0] = consumer
+            pending[1] = now
+            pending[2] += 1
+            return
+        self.pending[entry_id] = [consumer, now, 1]
+        if not self.pending_ids or self.pending_ids[-1] < entry_id:
+            self.pending_ids.append(entry_id)  # new entries are delivered in order, so this is the common case
+        else:
+            bisect.insort(self.pending_ids, entry_id)
+
+    def ack(self, entry_id):
+        """
+        Removes an entry from the pending entries list. Returns whether it was pending.
+        """
+        if entry_id not in self.pending:
+            return False
+        del self.pending[entry_id]
+        del self.pending_ids[bisect.bisect_left(self.pending_ids, entry_id)]
+        return True
+
+
+class RedisStreamMock:
+    """
+    Mocks Redis Streams
+    The entry ids are kept in an append only list, which is bisected to find ranges.
+    Trimming only moves the start of the stream forward, and the trimmed entries are dropped in bulk once they make up
+    half of the list, so trimming is cheap.
+    """
+
+    MAX_ID = (2 ** 64 - 1, 2 ** 64 - 1)
+
+    def __init__(self):
+        self.ids = []  # (ms, seq) tuples
+        self.entries = []  # the [field, value, ...] lists for the ids
+        self.first = 0  # the index of the first entry that hasn't been trimmed
+        self.last_id = (0, 0)
+        self.groups = {}
+
+    @staticmethod
+    def parse_id(entry_id, missing_seq=0):
+        """
+        Parses an entry id string (ms-seq, or just ms) into a (ms, seq) tuple
+        """
+        try:
+            parts = str(entry_id).split("-")
+            if len(parts) == 1:
+                parsed = (int(parts[0]), missing_seq)
+            elif len(parts) == 2:
+                parsed = (int(parts[0]), int(parts[1]))
+            else:
+                parsed = None
+        except ValueError:
+            parsed = None
+        if parsed is None or parsed[0] < 0 or parsed[1] < 0:
+            raise Exception("Invalid stream ID specified as stream command argument")
+        return parsed
+
+    @staticmethod
+    def format_id(entry_id):
+        """
+        Formats a (ms, seq) tuple as an entry id string
+        """
+        return "%d-%d" % entry_id
+
+    def length(self):
+        """
+        Performs the same functionality as XLEN
+        """
+        return len(self.ids) - self.first
+
+    def __get_entries(self, lo, hi, reverse=False):
+        """
+        Helper function to get the entries between the indexes lo and hi (exclusive) as (id, fields dict) tuples
+        """
+        indexes = xrange(lo, hi)
+        if reverse:
+            indexes = reversed(indexes)
+        ret = []
+        for i in indexes:
+            fields = self.entries[i]
+            ret.append((self.format_id(self.ids[i]), dict(zip(fields[0::2], fields[1::2]))))
+        return ret
+
+    def add(self, entry_id, fields, maxlen=None):
+        """
+        Performs the same functionality as XADD. Returns the id of the new entry.
+        """
+        if len(fields) == 0 or len(fields) % 2 != 0:
+            raise Exception("wrong number of arguments for 'xadd' command")
+        if entry_id == "*":
+            ms = int(time.time() * 1000)
+            if ms > self.last_id[0]:
+                new_id = (ms, 0)
+            else:
+                new_id = (self.last_id[0], self.last_id[1] + 1)
+        else:
+            new_id = self.parse_id(entry_id)
+            if new_id == (0, 0):
+                raise Exception("The ID specified in XADD must be greater than 0-0")
+            if new_id <= self.last_id:
+                raise Exception("The ID specified in XADD is equal or smaller than the target stream top item")
+        self.ids.append(new_id)
+        self.entries.append([str(field) for field in fields])
+        self.last_id = new_id
+        if maxlen is not None:
+            self.trim(maxlen)
+        return new_id
+
+    def trim(self, maxlen):
+        """
+        Performs the same functionality as XTRIM MAXLEN. Returns the number of entries removed.
+        """
+        removed = self.length() - maxlen
+        if removed <= 0:
+            return 0
+        self.first += removed
+        if self.first * 2 >= len(self.ids):
+            del self.ids[:self.first]
+            del self.entries[:self.first]
+            self.first = 0
+        return removed
+
+    def __parse_range_bound(self, bound, is_start):
+        """
+        Helper function to parse an XRANGE bound (-, +, an id, or an id prefixed with ( to exclude it)
+        into the index to bisect the ids at
+        """
+        bound = str(bound)
+        if bound == "-":
+            return self.first
+        if bound == "+":
+            return len(self.ids)
+        exclusive = bound.startswith("(")
+        if exclusive:
+            bound = bound[1:]
+        if is_start:
+            entry_id = self.parse_id(bound, 0)
+            if exclusive:
+                return bisect.bisect_right(self.ids, entry_id, self.first)
+            return bisect.bisect_left(self.ids, entry_id, self.first)
+        entry_id = self.parse_id(bound, self.MAX_ID[1])
+        if exclusive:
+            return bisect.bisect_left(self.ids, entry_id, self.first)
+        return bisect.bisect_right(self.ids, entry_id, self.first)
+
+    def range(self, start, end, count=None, reverse=False):
+        """
+        Performs the same functionality as XRANGE and XREVRANGE
+        """
+        lo = self.__parse_range_bound(start, True)
+        hi = self.__parse_range_bound(end, False)
+        if hi <= lo:
+            return []
+        if count is not None:
+            if reverse:
+                lo = max(lo, hi - count)
+            else:
+                hi = min(hi, lo + count)
+        return self.__get_entries(lo, hi, reverse)
+
+    def read(self, after_id, count=None):
+        """
+        Performs the same functionality as XREAD for a single stream, returning the entries after after_id
+        """
+        lo = bisect.bisect_right(self.ids, after_id, self.first)
+        hi = len(self.ids)
+        if count is not None:
+            hi = min(hi, lo + count)
+        return self.__get_entries(lo, hi)
+
+    def create_group(self, name, entry_id):
+        """
+        Performs the same functionality as XGROUP CREATE
+        """
+        if name in self.groups:
+            raise Exception("BUSYGROUP Consumer Group name already exists")
+        if entry_id == "$":
+            last_delivered_id = self.last_id
+        else:
+            last_delivered_id = self.parse_id(entry_id)
+        self.groups[name] = RedisStreamConsumerGroupMock(last_delivered_id)
+
+    def get_group(self, name):
+        """
+        Returns the consumer group with the given name, raising an exception if it doesn't exist
+        """
+        if name not in self.groups:
+            raise Exception("NOGROUP No such consumer group '%s'" % name)
+        return self.groups[name]
+
+    def read_group(self, name, consumer, entry_id, count=None, noack=False):
+        """
+        Performs the same functionality as XREADGROUP for a single stream.
+        With the id >, new entries are delivered to the consumer (and added to the pending entries list, unless noack).
+        With any other id, the consumer's pending entries after it are delivered again.
+        """
+        group = self.get_group(name)
+        now = int(time.time() * 1000)
+        if entry_id == ">":
+            ret = self.read(group.last_delivered_id, count)
+            if ret:
+                group.last_delivered_id = self.parse_id(ret[-1][0])
+                if not noack:
+                    for delivered_id, fields in ret:
+                        group.add_pending(self.parse_id(delivered_id), consumer, now)
+            return ret
+        after_id = self.parse_id(entry_id)
+        ret = []
+        for pending_id in group.pending_ids[bisect.bisect_right(group.pending_ids, after_id):]:
+            if group.pending[pending_id][0] != consumer:
+                continue
+            if count is not None and len(ret) >= count:
+                break
+            index = bisect.bisect_left(self.ids, pending_id, self.first)
+            if index < len(self.ids) and self.ids[index] == pending_id:
+                ret.extend(self.__get_entries(index, index + 1))
+                group.add_pending(pending_id, consumer, now)  # like Redis, this counts as another delivery
+            else:
+                ret.append((self.format_id(pending_id), None))  # the entry has been trimmed
+        return ret
+
+    def pending(self, name, start=None, end=None, count=None, consumer=None):
+        """
+        Performs the same functionality as XPENDING, in its summary form (without start, end and count)
+        or its extended form
+        """
+        group = self.get_group(name)
+        if start is None:
+            if not group.pending_ids:
+                return {'pending': 0, 'min': None, 'max': None, 'consumers': []}
+            consumers = {}
+            for pending_consumer, delivery_time, delivery_count in group.pending.itervalues():
+                consumers[pending_consumer] = consumers.get(pending_consumer, 0) + 1
+            return {
+                'pending': len(group.pending_ids),
+                'min': self.format_id(group.pending_ids[0]),
+                'max': self.format_id(group.pending_ids[-1]),
+                'consumers': [{'name': consumer_name, 'pending': num} for consumer_name, num in sorted(consumers.iteritems())],
+            }
+        start = str(start)
+        end = str(end)
+        lo = 0 if start == "-" else bisect.bisect_left(group.pending_ids, self.parse_id(start, 0))
+        hi = len(group.pending_ids) if end == "+" else bisect.bisect_right(group.pending_ids, self.parse_id(end, self.MAX_ID[1]))
+        now = int(time.time() * 1000)
+        ret = []
+        for pending_id in group.pending_ids[lo:hi]:
+            if len(ret) >= count:
+                break
+            pending_consumer, delivery_time, delivery_count = group.pending[pending_id]
+            if consumer is not None and pending_consumer != consumer:
+                continue
+            ret.append({
+                'message_id': self.format_id(pending_id),
+                'consumer': pending_consumer,
+                'time_since_delivered': now - delivery_time,
+                'times_delivered': delivery_count,
+            })
+        return ret
+
+    def __repr__(self):
+        """
+        Overwritten so you can print the stream
+        """
+        return str(self.range("-", "+"))
+
+
+class RedisMock:
+    db = {}
+    # Per-key version counters used by WATCH. Versions come from a single counter that is never reset,
+    # so a key that is deleted (e.g. by flush_db) and recreated never ends up with a version seen before.
+    versions = {}
+    version_counter = 0
+    # Guards the db so that EXEC can check the watched keys and run its queued commands atomically
+    lock = threading.RLock()
+    # Per-connection (i.e. per-thread) transaction state: the watched key versions and the MULTI queue
+    connection = threading.local()
+    # RedisMockAOF that write commands are logged to, or None if persistence is off
+    aof = None
+    # Stream key -> the conditions (on the lock) of the connections blocked reading it, which XADD notifies
+    stream_waiters = {}
+    # NetworkModel used to add latency and failures to every command, or None to answer instantly
+    network_model = None
+
+
+def flush_db():
+    """
+    Helper function to flush the RedisMock db between test runs.
+    Also discards the calling thread's transaction, so a test that fails inside a MULTI doesn't affect the next one.
+    """
+    with RedisMock.lock:
+        RedisMock.db = {}
+        RedisMock.versions = {}
+        state = __get_transaction_state()
+        state.watched = {}
+        state.queue = None
+        if RedisMock.aof is not None:
+            RedisMock.aof.append(("FLUSHDB",), {})
+            RedisMock.aof.commit()
+
+
+def print_db():
+    """
+    Helper function to print the RedisMock db. Used for debugging purposes.
+    """
+    print RedisMock.db
+
+
+def set_network_model(network_model):
+    """
+    Helper function to add the latency and failures of a NetworkModel to every command.
+    Pass None to go back to answering instantly.
+    """
+    RedisMock.network_model = network_model
+
+
+def enable_aof(path, appendfsync="everysec"):
+    """
+    Helper function to persist the RedisMock db to an append only file at path.
+    If the file already exists, its commands are replayed first (on top of the current db).
+    appendfsync is one of "always" (fsync after every command), "everysec" (fsync once a second in the background)
+    or "no" (leave it up to the OS).
+    """
+    with RedisMock.lock:
+        if RedisMock.aof is not None:
+            raise Exception("The append only file is already enabled: %s" % RedisMock.aof.path)
+        aof = RedisMockAOF(path, appendfsync)
+        aof.load(__replay_command)
+        aof.open()
+        RedisMock.aof = aof
+
+
+def disable_aof():
+    """
+    Helper function to stop persisting the RedisMock db. Everything logged so far is flushed and fsynced.
+    """
+    with RedisMock.lock:
+        if RedisMock.aof is not None:
+            RedisMock.aof.close()
+            RedisMock.aof = None
+
+
+def rewrite_aof():
+    """
+    Helper function to compact the append only file, like BGREWRITEAOF.
+    The db is snapshotted right away and the new file is written in a background thread,
+    which is returned so that you can join() it.
+    """
+    with RedisMock.lock:
+        if RedisMock.aof is None:
+            raise Exception("The append only file is not enabled")
+        return RedisMock.aof.rewrite()
+
+
+def __parse_range_command(*args, **options):
+    """
+    Internal helper function to parse the arguments out of a RANGE type command
+    """
+    key = str(args[1])
+    start = args[2]
+    stop = args[3]
+    withscores = False
+    if 'withscores' in options:
+        withscores = options['withscores']
+    return (key, start, stop, withscores)
+
+
+def __parse_range_options(**options):
+    """
+    Internal helper function to parse the score_cast_func and stream options of a RANGE type command
+    """
+    score_cast_func = options.get('score_cast_func', float)
+    stream = options.get('stream', False)
+    return (score_cast_func, stream)
+
+
+def __parse_limit(*args):
+    """
+    Internal helper function to parse the offset and count out of a command's LIMIT arguments.
+    Returns (None, None) if there is no LIMIT.
+    """
+    # redis-py passes LIMIT as a Token object, so compare its string value
+    for i, arg in enumerate(args):
+        if str(arg).upper() == "LIMIT":
+            return (int(args[i + 1]), int(args[i + 2]))
+    return (None, None)
+
+
+def __touch_key(key):
+    """
+    Internal helper function to bump the version of a key that has been written to.
+    Any connection watching the key will have its next EXEC aborted.
+    """
+    RedisMock.version_counter += 1
+    RedisMock.versions[key] = RedisMock.version_counter
+
 
-        all_items = self.__get_sorted_by_score(reverse=reverse)
-        if min_inclusive:
-            all_items = filter(lambda x: x[1] >= min_value, all_items)
-        else:
-            all_items = filter(lambda x: x[1] > min_value, all_items)
-        if max_inclusive:
-            all_items = filter(lambda x: x[1] <= max_value, all_items)
-        else:
-            all_items = filter(lambda x: x[1] < max_value, all_items)
+def __replay_command(args, options):
+    """
+    Internal helper function to replay a command from the append only file. It's run straight on the db,
+    bypassing the network model and the calling thread's transaction.
+    """
+    if args[0] == "FLUSHDB":
+        RedisMock.db = {}
+        RedisMock.versions = {}
+    elif args[0] == "RESTORE":
+        # a value saved whole by a rewrite
+        key = args[1]
+        RedisMock.db[key] = cPickle.loads(args[2])
+        __touch_key(key)
+    else:
+        state = __get_transaction_state()
+        state.executing = True  # a logged blocking read already has its result, so it mustn't block
+        try:
+            __execute_command(*args, **options)
+        finally:
+            state.executing = False
 
-        if offset is not None and count is not None:
-            all_items = all_items[offset:count+offset]
 
-        if withscores:
-            return all_items
-        return [member for member, score in all_items]
+def __get_transaction_state():
+    """
+    Internal helper function to get the transaction state of the current connection
+    """
+    state = RedisMock.connection
+    if not hasattr(state, 'watched'):
+        state.watched = {}  # key -> version when WATCH was called
+        state.queue = None  # list of queued (args, options) while in a MULTI, None otherwise
+        state.executing = False  # whether the queued commands are being run by EXEC (so they mustn't block)
+    return state
 
-    def __repr__(self):
-        """
-        Overwritten so you can print the sorted set
-        """
-        return str(self.dict)
+
+def __wait_for_streams(keys, timeout):
+    """
+    Internal helper function to block the current connection until an entry is added to one of the stream keys,
+    or the timeout (in seconds, or None to wait forever) passes. Must be called with the RedisMock lock held.
+    """
+    condition = threading.Condition(RedisMock.lock)
+    for key in keys:
+        RedisMock.stream_waiters.setdefault(key, []).append(condition)
+    # Condition.wait(timeout) polls (sleeping up to 50ms at a time) on Python 2, so wait without one,
+    # and have a timer wake the connection up at the timeout instead
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, __notify_waiter, (condition,))
+        timer.daemon = True
+        timer.start()
+    try:
+        condition.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        for key in keys:
+            waiters = RedisMock.stream_waiters[key]
+            waiters.remove(condition)
+            if not waiters:
+                del RedisMock.stream_waiters[key]
 
 
-class RedisMock:
-    db = {}
+def __notify_waiter(condition):
+    """
+    Internal helper function to wake up a connection blocked in __wait_for_streams
+    """
+    with condition:
+        condition.notify()
 
 
-def flush_db():
+def execute_command(*args, **options):
     """
-    Helper function to flush the RedisMock db between test runs
+    Function used to overrite the Redis execute_command function so we can mock redis
+
+    Each thread is treated as its own connection, so WATCH, MULTI, EXEC and DISCARD only affect the
+    calling thread's transaction.
     """
-    RedisMock.db = {}
+    network_model = RedisMock.network_model
+    if network_model is not None:
+        # Each call is a round trip. Commands queued by MULTI only cost the round trip, and are paid for by EXEC.
+        state = __get_transaction_state()
+        if state.queue is None:
+            commands = [args[0]]
+        elif args[0] == "EXEC":
+            commands = [queued_args[0] for queued_args, queued_options in state.queue]
+        else:
+            commands = []
+        try:
+            delay = network_model.begin_round_trip(commands)
+        except redis.exceptions.RedisError:
+            __drop_connection(state)
+            raise
+    try:
+        with RedisMock.lock:
+            try:
+                return __execute_transaction_command(*args, **options)
+            finally:
+                if RedisMock.aof is not None:
+                    # everything logged by this command (or transaction) is committed together
+                    RedisMock.aof.commit()
+    finally:
+        # an error reply pays for the round trip (and can time out) too
+        if network_model is not None:
+            try:
+                network_model.end_round_trip(delay)
+            except redis.exceptions.RedisError:
+                __drop_connection(state)
+                raise
 
 
-def print_db():
+def __drop_connection(state):
     """
-    Helper function to print the RedisMock db. Used for debugging purposes.
+    Internal helper function to discard a connection's transaction and watched keys after the network model failed
+    a round trip, like Redis does when a client's connection is dropped (which redis-py does after an error)
     """
-    print RedisMock.db
+    state.queue = None
+    state.watched = {}
 
 
-def __parse_range_command(*args, **options):
+def __log_command(args, options, ret):
     """
-    Internal helper function to parse the arguments out of a RANGE type command
+    Internal helper function to log a successful write command (and what it returned) to the append only file
+    """
+    if RedisMock.aof is None or args[0] not in WriteCommands:
+        return
+    if args[0] == "XADD":
+        # log the id that was generated, so that the entry gets the same id when it's replayed
+        id_index = __parse_xadd(*args)[3]
+        args = args[:id_index] + (ret,) + args[id_index + 1:]
+    elif args[0] == "XREADGROUP" and ret is None:
+        return  # nothing was delivered
+    RedisMock.aof.append(args, options)
+
+
+def __execute_transaction_command(*args, **options):
+    """
+    Internal helper function that handles the transaction commands, and queues commands while in a MULTI
+    """
+    command = args[0]
+    state = __get_transaction_state()
+    # Transaction commands
+    if command == "WATCH":
+        if state.queue is not None:
+            raise Exception("WATCH inside MULTI is not allowed")
+        for key in args[1:]:
+            key = str(key)
+            state.watched[key] = RedisMock.versions.get(key, 0)
+        return True
+    elif command == "UNWATCH":
+        state.watched = {}
+        return True
+    elif command == "MULTI":
+        if state.queue is not None:
+            raise Exception("MULTI calls can not be nested")
+        state.queue = []
+        return True
+    elif command == "DISCARD":
+        if state.queue is None:
+            raise Exception("DISCARD without MULTI")
+        state.queue = None
+        state.watched = {}
+        return True
+    elif command == "EXEC":
+        if state.queue is None:
+            raise Exception("EXEC without MULTI")
+        queue = state.queue
+        watched = state.watched
+        state.queue = None
+        state.watched = {}
+        for key, version in watched.iteritems():
+            if RedisMock.versions.get(key, 0) != version:
+                return None  # a watched key was modified, so the transaction is aborted
+        ret = []
+        state.executing = True
+        try:
+            for queued_args, queued_options in queue:
+                try:
+                    result = __execute_command(*queued_args, **queued_options)
+                    ret.append(result)
+                    __log_command(queued_args, queued_options, result)
+                except Exception as e:
+                    # Like Redis, an error in one command doesn't stop the rest of the transaction
+                    ret.append(e)
+        finally:
+            state.executing = False
+        return ret
+    elif state.queue is not None:
+        state.queue.append((args, options))
+        return "QUEUED"
+    ret = __execute_command(*args, **options)
+    __log_command(args, options, ret)
+    return ret
+
+
+def __parse_xadd(*args):
+    """
+    Internal helper function to parse the arguments of XADD into (key, maxlen, fields, the index of the id in args)
     """
     key = str(args[1])
-    start = args[2]
-    stop = args[3]
-    withscores = False
-    if 'withscores' in options:
-        withscores = options['withscores']
-    return (key, start, stop, withscores)
+    maxlen = None
+    i = 2
+    if len(args) > i and str(args[i]).upper() == "MAXLEN":
+        i += 1
+        if len(args) > i and str(args[i]) in ("~", "="):
+            i += 1  # the trimming is always exact, which is allowed for ~
+        if len(args) <= i:
+            raise Exception("syntax error")
+        maxlen = int(args[i])
+        if maxlen < 0:
+            raise Exception("The MAXLEN argument must be >= 0.")
+        i += 1
+    if len(args) <= i:
+        raise Exception("wrong number of arguments for 'xadd' command")
+    return (key, maxlen, args[i + 1:], i)
 
 
-def execute_command(*args, **options):
+def __parse_xread(*args):
     """
-    Function used to overrite the Redis execute_command function so we can mock redis
+    Internal helper function to parse the arguments of XREAD and XREADGROUP into
+    (group, consumer, count, block (in ms, or None), noack, keys, ids)
+    """
+    group = None
+    consumer = None
+    count = None
+    block = None
+    noack = False
+    i = 1
+    while i < len(args):
+        arg = str(args[i]).upper()
+        if arg == "STREAMS":
+            break
+        elif arg == "GROUP" and i + 2 < len(args):
+            group = str(args[i + 1])
+            consumer = str(args[i + 2])
+            i += 3
+        elif arg == "COUNT" and i + 1 < len(args):
+            count = int(args[i + 1])
+            i += 2
+        elif arg == "BLOCK" and i + 1 < len(args):
+            block = int(args[i + 1])
+            if block < 0:
+                raise Exception("timeout is negative")
+            i += 2
+        elif arg == "NOACK":
+            noack = True
+            i += 1
+        else:
+            raise Exception("syntax error")
+    streams = [str(arg) for arg in args[i + 1:]]
+    if len(streams) == 0 or len(streams) % 2 != 0:
+        raise Exception("Unbalanced XREAD list of streams: for each stream key an ID or '$' must be specified.")
+    half = len(streams) / 2
+    return (group, consumer, count, block, noack, streams[:half], streams[half:])
+
+
+def __get_stream(command, key):
+    """
+    Internal helper function to get the stream at key. Returns None if the key doesn't exist.
+    """
+    if key not in RedisMock.db:
+        return None
+    stream = RedisMock.db[key]
+    if not isinstance(stream, RedisStreamMock):
+        raise Exception("Calling %s on key %s should be of type stream. current type: %s" % (command, key, type(stream)))
+    return stream
+
+
+def __execute_command(*args, **options):
+    """
+    Internal helper function that runs a single (non-transaction) Redis command against the RedisMock db
     """
     command = args[0]
     # Redis Sorted Set commands
     if command == "ZADD":
         key = str(args[1])
         if key not in RedisMock.db:
-            RedisMock.db[key] = RedisSortedSetMock()
-            return RedisMock.db[key].add(*args[2:])
+            sorted_set = RedisSortedSetMock()
+            ret = sorted_set.add(*args[2:])
+            RedisMock.db[key] = sorted_set
         else:
             sorted_set = RedisMock.db[key]
             if not isinstance(sorted_set, RedisSortedSetMock):
                 raise Exception("Calling ZADD on key %s should be of type sorted set. current type: %s" % (key, type(sorted_set)))
-            return sorted_set.add(*args[2:])
+            ret = sorted_set.add(*args[2:])
+        __touch_key(key)
+        return ret
     elif command == "ZRANGE":
         key, start, stop, withscores = __parse_range_command(*args, **options)
+        score_cast_func, stream = __parse_range_options(**options)
         if key not in RedisMock.db:
             return []
         else:
-            return RedisMock.db[key].range(start, stop, withscores)
+            return RedisMock.db[key].range(start, stop, withscores, score_cast_func=score_cast_func, stream=stream)
     elif command == "ZREVRANGE":
         key, start, stop, withscores = __parse_range_command(*args, **options)
+        score_cast_func, stream = __parse_range_options(**options)
         if key not in RedisMock.db:
             return []
         else:
-            return RedisMock.db[key].range(start, stop, withscores, reverse=True)
+            return RedisMock.db[key].range(start, stop, withscores, reverse=True, score_cast_func=score_cast_func,
+                                           stream=stream)
     elif command == "ZRANGEBYSCORE":
         key, min, max, withscores = __parse_range_command(*args, **options)
-        offset = None
-        count = None
-        if len(args) == 6:
-            offset = args[4]
-            count = args[5]
+        score_cast_func, stream = __parse_range_options(**options)
+        offset, count = __parse_limit(*args[4:])
         if key not in RedisMock.db:
             return []
         else:
-            return RedisMock.db[key].rangebyscore(min, max, withscores, offset, count)
+            return RedisMock.db[key].rangebyscore(min, max, withscores, offset, count, score_cast_func=score_cast_func,
+                                                  stream=stream)
     elif command == "ZREVRANGEBYSCORE":
         # the ordering for min and max are flipped for ZREVRANGEBYSCORE
         key, max, min, withscores = __parse_range_command(*args, **options)
-        offset = None
-        count = None
-        if len(args) == 6:
-            offset = args[4]
-            count = args[5]
+        score_cast_func, stream = __parse_range_options(**options)
+        offset, count = __parse_limit(*args[4:])
         if key not in RedisMock.db:
             return []
         else:
-            return RedisMock.db[key].rangebyscore(min, max, withscores, offset, count, reverse=True)
+            return RedisMock.db[key].rangebyscore(min, max, withscores, offset, count, reverse=True,
+                                                  score_cast_func=score_cast_func, stream=stream)
+    elif command in ("ZRANGEBYLEX", "ZREVRANGEBYLEX"):
+        key = str(args[1])
+        min = args[2]
+        max = args[3]
+        if command == "ZREVRANGEBYLEX":
+            # the ordering for min and max are flipped for ZREVRANGEBYLEX
+            min, max = max, min
+        offset, count = __parse_limit(*args[4:])
+        stream = __parse_range_options(**options)[1]  # members only, so there are no scores to cast
+        if key not in RedisMock.db:
+            return []
+        sorted_set = RedisMock.db[key]
+        if not isinstance(sorted_set, RedisSortedSetMock):
+            raise Exception("Calling %s on key %s should be of type sorted set. current type: %s" % (command, key, type(sorted_set)))
+        return sorted_set.rangebylex(min, max, offset, count, reverse=(command == "ZREVRANGEBYLEX"), stream=stream)
+    elif command == "ZLEXCOUNT":
+        key = str(args[1])
+        if key not in RedisMock.db:
+            return 0
+        sorted_set = RedisMock.db[key]
+        if not isinstance(sorted_set, RedisSortedSetMock):
+            raise Exception("Calling ZLEXCOUNT on key %s should be of type sorted set. current type: %s" % (key, type(sorted_set)))
+        return sorted_set.lexcount(args[2], args[3])
+    elif command == "ZREMRANGEBYLEX":
+        key = str(args[1])
+        if key not in RedisMock.db:
+            return 0
+        sorted_set = RedisMock.db[key]
+        if not isinstance(sorted_set, RedisSortedSetMock):
+            raise Exception("Calling ZREMRANGEBYLEX on key %s should be of type sorted set. current type: %s" % (key, type(sorted_set)))
+        num_removed = sorted_set.remrangebylex(args[2], args[3])
+        if num_removed:
+            if not sorted_set.dict:
+                del RedisMock.db[key]  # like Redis, empty sorted sets are deleted
+            __touch_key(key)
+        return num_removed
     # Redis Set commands
     elif command == "SADD":
         key = str(args[1])
         members = [str(member) for member in args[2:]]
         if key not in RedisMock.db:
             RedisMock.db[key] = set(members)
+            __touch_key(key)
             return len(members)
         else:
             current_set = RedisMock.db[key]
@@ -266,6 +1739,8 @@ def execute_command(*args, **options):
                     continue
                 current_set.add(member)
                 num_added += 1
+            if num_added:
+                __touch_key(key)
             return num_added
     elif command == "SISMEMBER":
         key = str(args[1])
@@ -319,4 +1794,866 @@ def execute_command(*args, **options):
             except KeyError:
                 pass
         return current_set - accumulator_set
+    # Redis bitmap commands
+    elif command == "SETBIT":
+        key = str(args[1])
+        if key not in RedisMock.db:
+            bitmap = RedisBitmapMock()
+            ret = bitmap.setbit(args[2], args[3])
+            RedisMock.db[key] = bitmap
+        else:
+            bitmap = RedisMock.db[key]
+            if not isinstance(bitmap, RedisBitmapMock):
+                raise Exception("Calling SETBIT on key %s should be of type bitmap. current type: %s" % (key, type(bitmap)))
+            ret = bitmap.setbit(args[2], args[3])
+        __touch_key(key)
+        return ret
+    elif command in ("GETBIT", "BITCOUNT", "BITPOS"):
+        key = str(args[1])
+        if key not in RedisMock.db:
+            if command == "BITPOS":
+                return -1 if int(args[2]) else 0  # a missing key is all 0s
+            bitmap = RedisBitmapMock()
+        else:
+            bitmap = RedisMock.db[key]
+            if not isinstance(bitmap, RedisBitmapMock):
+                raise Exception("Calling %s on key %s should be of type bitmap. current type: %s" % (command, key, type(bitmap)))
+        if command == "GETBIT":
+            return bitmap.getbit(args[2])
+        elif command == "BITCOUNT":
+            return bitmap.bitcount(*args[2:4])
+        return bitmap.bitpos(*args[2:5])
+    elif command == "BITOP":
+        operation = args[1]
+        dest_key = str(args[2])
+        bitmaps = []
+        for key in args[3:]:
+            key = str(key)
+            if key not in RedisMock.db:
+                bitmaps.append(RedisBitmapMock())
+                continue
+            bitmap = RedisMock.db[key]
+            if not isinstance(bitmap, RedisBitmapMock):
+                raise Exception("Calling BITOP on key %s should be of type bitmap. current type: %s" % (key, type(bitmap)))
+            bitmaps.append(bitmap)
+        result = RedisBitmapMock.bitop(operation, bitmaps)
+        if len(result.bytes) == 0:
+            # like Redis, an empty result deletes the destination key
+            if dest_key in RedisMock.db:
+                del RedisMock.db[dest_key]
+                __touch_key(dest_key)
+            return 0
+        RedisMock.db[dest_key] = result
+        __touch_key(dest_key)
+        return len(result.bytes)
+    elif command == "BITFIELD":
+        key = str(args[1])
+        if key not in RedisMock.db:
+            bitmap = RedisBitmapMock()
+        else:
+            bitmap = RedisMock.db[key]
+            if not isinstance(bitmap, RedisBitmapMock):
+                raise Exception("Calling BITFIELD on key %s should be of type bitmap. current type: %s" % (key, type(bitmap)))
+        ret, written = bitmap.bitfield(*args[2:])
+        if written:
+            RedisMock.db[key] = bitmap
+            __touch_key(key)
+        return ret
+    # Redis Stream commands
+    elif command == "XADD":
+        key, maxlen, fields, id_index = __parse_xadd(*args)
+        stream = __get_stream(command, key)
+        if stream is None:
+            stream = RedisStreamMock()
+            new_id = stream.add(str(args[id_index]), fields, maxlen)
+            RedisMock.db[key] = stream
+        else:
+            new_id = stream.add(str(args[id_index]), fields, maxlen)
+        __touch_key(key)
+        for condition in RedisMock.stream_waiters.get(key, []):
+            condition.notify()
+        return RedisStreamMock.format_id(new_id)
+    elif command == "XLEN":
+        stream = __get_stream(command, str(args[1]))
+        if stream is None:
+            return 0
+        return stream.length()
+    elif command == "XTRIM":
+        key = str(args[1])
+        if len(args) < 4 or str(args[2]).upper() != "MAXLEN":
+            raise Exception("syntax error")
+        maxlen = args[-1]
+        stream = __get_stream(command, key)
+        if stream is None:
+            return 0
+        num_removed = stream.trim(int(maxlen))
+        if num_removed:
+            __touch_key(key)
+        return num_removed
+    elif command in ("XRANGE", "XREVRANGE"):
+        key = str(args[1])
+        start = args[2]
+        end = args[3]
+        if command == "XREVRANGE":
+            # the ordering for start and end are flipped for XREVRANGE
+            start, end = end, start
+        count = None
+        if len(args) > 5 and str(args[4]).upper() == "COUNT":
+            count = int(args[5])
+        stream = __get_stream(command, key)
+        if stream is None:
+            return []
+        return stream.range(start, end, count, reverse=(command == "XREVRANGE"))
+    elif command in ("XREAD", "XREADGROUP"):
+        group, consumer, count, block, noack, keys, ids = __parse_xread(*args)
+        if command == "XREADGROUP" and group is None:
+            raise Exception("Missing GROUP option for XREADGROUP")
+        if command == "XREAD" and group is not None:
+            raise Exception("The GROUP option is only supported by XREADGROUP. You called XREAD instead.")
+        # Resolve $ to the last id now, so that only entries added after the call are returned if it blocks
+        after_ids = []
+        for key, entry_id in zip(keys, ids):
+            stream = __get_stream(command, key)
+            if command == "XREADGROUP":
+                if stream is None:
+                    raise Exception("NOGROUP No such key '%s' or consumer group '%s'" % (key, group))
+                stream.get_group(group)
+                after_ids.append(entry_id)
+            elif entry_id == "$":
+                after_ids.append(stream.last_id if stream is not None else (0, 0))
+            else:
+                after_ids.append(RedisStreamMock.parse_id(entry_id))
+        # Like Redis, only block if reading new entries (and never inside a transaction)
+        can_block = block is not None and not __get_transaction_state().executing
+        if command == "XREADGROUP" and any(entry_id != ">" for entry_id in after_ids):
+            can_block = False
+        # Another connection's write can't be predicted, so blocking always waits in real time
+        blocked_since = time.time()
+        deadline = None
+        if block:
+            deadline = blocked_since + block / 1000.0
+        blocked = False
+        while True:
+            ret = []
+            for key, after_id in zip(keys, after_ids):
+                stream = __get_stream(command, key)
+                if stream is None:
+                    continue
+                if command == "XREADGROUP":
+                    entries = stream.read_group(group, consumer, after_id, count, noack)
+                    if entries or after_id != ">":
+                        ret.append([key, entries])
+                else:
+                    entries = stream.read(after_id, count)
+                    if entries:
+                        ret.append([key, entries])
+            if ret or not can_block:
+                break
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+            __wait_for_streams(keys, timeout)
+            blocked = True
+        network_model = RedisMock.network_model
+        if blocked and network_model is not None and isinstance(network_model.clock, VirtualClock):
+            # a VirtualClock only moves when slept on, so add the time spent blocked to it
+            network_model.clock.sleep(time.time() - blocked_since)
+        if not ret:
+            return None
+        if command == "XREADGROUP":
+            for key, entries in ret:
+                if entries:
+                    __touch_key(key)
+        return ret
+    elif command == "XGROUP":
+        subcommand = str(args[1]).upper()
+        key = str(args[2])
+        if subcommand == "CREATE":
+            if len(args) < 5:
+                raise Exception("wrong number of arguments for 'xgroup' command")
+            mkstream = len(args) > 5 and str(args[5]).upper() == "MKSTREAM"
+            stream = __get_stream(command, key)
+            if stream is None:
+                if not mkstream:
+                    raise Exception("The XGROUP subcommand requires the key to exist. Note that for CREATE you may want to use the MKSTREAM option to create an empty stream automatically.")
+                # only store the new stream once its group has been created, so a bad id doesn't leave it behind
+                stream = RedisStreamMock()
+                stream.create_group(str(args[3]), str(args[4]))
+                RedisMock.db[key] = stream
+            else:
+                stream.create_group(str(args[3]), str(args[4]))
+            __touch_key(key)
+            return True
+        elif subcommand == "DESTROY":
+            stream = __get_stream(command, key)
+            if stream is None or str(args[3]) not in stream.groups:
+                return 0
+            del stream.groups[str(args[3])]
+            __touch_key(key)
+            return 1
+        raise Exception("Unimplemented XGROUP subcommand: %s" % subcommand)
+    elif command == "XACK":
+        key = str(args[1])
+        stream = __get_stream(command, key)
+        if stream is None or str(args[2]) not in stream.groups:
+            return 0
+        group = stream.groups[str(args[2])]
+        num_acked = 0
+        for entry_id in args[3:]:
+            if group.ack(RedisStreamMock.parse_id(entry_id)):
+                num_acked += 1
+        if num_acked:
+            __touch_key(key)
+        return num_acked
+    elif command == "XPENDING":
+        key = str(args[1])
+        stream = __get_stream(command, key)
+        if stream is None:
+            raise Exception("NOGROUP No such key '%s' or consumer group '%s'" % (key, args[2]))
+        if len(args) == 3:
+            return stream.pending(str(args[2]))
+        if len(args) < 6:
+            raise Exception("syntax error")
+        consumer = None
+        if len(args) > 6:
+            consumer = str(args[6])
+        return stream.pending(str(args[2]), args[3], args[4], int(args[5]), consumer)
+    # Redis HyperLogLog commands
+    elif command == "PFADD":
+        key = str(args[1])
+        if key not in RedisMock.db:
+            hyperloglog = RedisHyperLogLogMock()
+            hyperloglog.add(*args[2:])
+            RedisMock.db[key] = hyperloglog
+            changed = True
+        else:
+            hyperloglog = RedisMock.db[key]
+            if not isinstance(hyperloglog, RedisHyperLogLogMock):
+                raise Exception("Calling PFADD on key %s should be of type HyperLogLog. current type: %s" % (key, type(hyperloglog)))
+            changed = hyperloglog.add(*args[2:])
+        if changed:
+            __touch_key(key)
+            return 1
+        return 0
+    elif command == "PFCOUNT":
+        hyperloglogs = []
+        for key in args[1:]:
+            key = str(key)
+            if key not in RedisMock.db:
+                continue
+            hyperloglog = RedisMock.db[key]
+            if not isinstance(hyperloglog, RedisHyperLogLogMock):
+                raise Exception("Calling PFCOUNT on key %s should be of type HyperLogLog. current type: %s" % (key, type(hyperloglog)))
+            hyperloglogs.append(hyperloglog)
+        if len(hyperloglogs) == 0:
+            return 0
+        if len(hyperloglogs) == 1:
+            return hyperloglogs[0].count()
+        # count the union without modifying any of the keys
+        union = RedisHyperLogLogMock()
+        for hyperloglog in hyperloglogs:
+            union.merge(hyperloglog)
+        return union.count()
+    elif command == "PFMERGE":
+        dest_key = str(args[1])
+        sources = []
+        for key in args[2:]:
+            key = str(key)
+            if key not in RedisMock.db:
+                continue
+            hyperloglog = RedisMock.db[key]
+            if not isinstance(hyperloglog, RedisHyperLogLogMock):
+                raise Exception("Calling PFMERGE on key %s should be of type HyperLogLog. current type: %s" % (key, type(hyperloglog)))
+            sources.append(hyperloglog)
+        if dest_key not in RedisMock.db:
+            dest = RedisHyperLogLogMock()
+        else:
+            dest = RedisMock.db[dest_key]
+            if not isinstance(dest, RedisHyperLogLogMock):
+                raise Exception("Calling PFMERGE on key %s should be of type HyperLogLog. current type: %s" % (dest_key, type(dest)))
+        for hyperloglog in sources:
+            if hyperloglog is not dest:
+                dest.merge(hyperloglog)
+        RedisMock.db[dest_key] = dest
+        __touch_key(dest_key)
+        return True
     raise Exception("Unimplemented Redis command: %s" % command)
+
+
+
+class RedisMockAOF:
+    """
+    Append only file for the RedisMock db.
+    Each write command is logged as a pickled (args, options) record. Records are buffered and written out
+    together once the command (or transaction) that logged them is done.
+    """
+
+    # The max number of members in a single command when rewriting a large key
+    REWRITE_ITEMS_PER_COMMAND = 1000
+
+    def __init__(self, path, appendfsync="everysec"):
+        if appendfsync not in AppendFsyncPolicies:
+            raise Exception("appendfsync must be one of %s. appendfsync: %s" % (AppendFsyncPolicies, appendfsync))
+        self.path = path
+        self.appendfsync = appendfsync
+        self.file = None
+        self.buffer = []
+        self.rewrite_buffer = None  # records logged while a rewrite is in progress, None otherwise
+        self.file_lock = threading.Lock()  # guards self.file against the background fsync and rewrite threads
+        self.closed = threading.Event()
+        self.fsync_thread = None
+
+    def load(self, replay):
+        """
+        Replays the commands in the file by calling replay(args, options) with each one. A partially written record
+        at the end of the file (e.g. if the process died in the middle of a write) is truncated.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        stream = cStringIO.StringIO(data)
+        unpickler = cPickle.Unpickler(stream)
+        valid_length = 0
+        while valid_length < len(data):
+            try:
+                args, options = unpickler.load()
+            except (EOFError, cPickle.UnpicklingError, ValueError):
+                break
+            valid_length = stream.tell()
+            replay(args, options)
+        if valid_length < len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_length)
+
+    def open(self):
+        """
+        Opens the file for appending, and starts the background fsync thread if needed
+        """
+        self.file = open(self.path, 'ab')
+        if self.appendfsync == "everysec":
+            self.fsync_thread = threading.Thread(target=self.__fsync_every_second)
+            self.fsync_thread.daemon = True
+            self.fsync_thread.start()
+
+    def close(self):
+        """
+        Writes out anything that's buffered, fsyncs and closes the file
+        """
+        self.commit()
+        self.closed.set()
+        if self.fsync_thread is not None:
+            self.fsync_thread.join()
+            self.fsync_thread = None
+        with self.file_lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    def append(self, args, options):
+        """
+        Buffers a command to be logged. Nothing is written until commit() is called.
+        """
+        # redis-py passes some arguments as Token objects, so log everything that isn't a plain value as a string
+        args = tuple(arg if isinstance(arg, (types.StringTypes,) + ScoreTypes) else str(arg) for arg in args)
+        record = cPickle.dumps((args, options), cPickle.HIGHEST_PROTOCOL)
+        self.buffer.append(record)
+        if self.rewrite_buffer is not None:
+            self.rewrite_buffer.append(record)
+
+    def commit(self):
+        """
+        Writes the buffered commands to the file in a single write, fsyncing it if appendfsync is "always"
+        """
+        if not self.buffer:
+            return
+        data = "".join(self.buffer)
+        self.buffer = []
+        with self.file_lock:
+            self.file.write(data)
+            self.file.flush()
+            if self.appendfsync == "always":
+                os.fsync(self.file.fileno())
+
+    def __fsync_every_second(self):
+        """
+        Helper function run by the background fsync thread when appendfsync is "everysec"
+        """
+        while not self.closed.wait(1):
+            with self.file_lock:
+                if self.file is None:
+                    return
+                # fsync a duplicate of the file descriptor so that commands aren't blocked while the disk catches up
+                fd = os.dup(self.file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def rewrite(self):
+        """
+        Starts rewriting the file with the minimal set of commands needed to recreate the current db.
+        Must be called with the RedisMock lock held. Returns the background thread doing the rewrite.
+        """
+        if self.rewrite_buffer is not None:
+            raise Exception("An append only file rewrite is already in progress")
+        # Take a (shallow) copy of the db now, so the slow part can be done without holding the lock
+        snapshot = [(key, self.__snapshot_value(value)) for key, value in RedisMock.db.iteritems()]
+        self.rewrite_buffer = []
+        thread = threading.Thread(target=self.__rewrite, args=(snapshot,))
+        thread.start()
+        return thread
+
+    def __snapshot_value(self, value):
+        """
+        Helper function to copy a value in the db so that it can be rewritten in the background.
+        Returns the command that will be used to recreate it, and the copy.
+        """
+        if isinstance(value, RedisSortedSetMock):
+            return ("ZADD", dict(value.dict))
+        if isinstance(value, set):
+            return ("SADD", set(value))
+        # There's no command that recreates the value directly (e.g. a HyperLogLog's registers), so save it whole
+        return ("RESTORE", cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+    def __rewrite_commands(self, key, snapshot):
+        """
+        Helper function to generate the commands that recreate a snapshotted value
+        """
+        command, value = snapshot
+        if command == "ZADD":
+            items = value.items()
+            for i in xrange(0, len(items), self.REWRITE_ITEMS_PER_COMMAND):
+                args = ["ZADD", key]
+                for member, score in items[i:i + self.REWRITE_ITEMS_PER_COMMAND]:
+                    args.append(score)
+                    args.append(member)
+                yield tuple(args)
+        elif command == "SADD":
+            members = list(value)
+            for i in xrange(0, len(members), self.REWRITE_ITEMS_PER_COMMAND):
+                yield ("SADD", key) + tuple(members[i:i + self.REWRITE_ITEMS_PER_COMMAND])
+        else:
+            yield ("RESTORE", key, value)
+
+    def __rewrite(self, snapshot):
+        """
+        Helper function run by the background rewrite thread
+        """
+        tmp_path = "%s.rewrite-%s" % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+                pickler.fast = True  # records don't reference each other, so don't bother memoizing
+                for key, value in snapshot:
+                    for args in self.__rewrite_commands(key, value):
+                        pickler.dump((args, {}))
+                f.flush()
+                os.fsync(f.fileno())
+            # Append whatever was logged during the rewrite, then swap in the new file
+            with RedisMock.lock:
+                if self.file is None:
+                    return  # the append only file was disabled during the rewrite
+                self.commit()
+                with open(tmp_path, 'ab') as f:
+                    f.write("".join(self.rewrite_buffer))
+                    f.flush()
+                    os.fsync(f.fileno())
+                with self.file_lock:
+                    os.rename(tmp_path, self.path)
+                    self.file.close()
+                    self.file = open(self.path, 'ab')
+        finally:
+            with RedisMock.lock:
+                self.rewrite_buffer = None
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class RedisMockServer:
+    """
+    Runs a single RedisMock db in its own process, listening on a Unix socket.
+    This lets multiple processes (e.g. pytest-xdist or multiprocessing workers) share one mock Redis.
+    Connect to it with RedisMockClient.
+    If aof_path is given, the server's db is persisted to that append only file (see enable_aof).
+    """
+
+    def __init__(self, address=None, aof_path=None, appendfsync="everysec"):
+        self.aof_path = aof_path
+        self.appendfsync = appendfsync
+        self.tmp_dir = None
+        if address is None:
+            self.tmp_dir = tempfile.mkdtemp(prefix="redis_mock")
+            address = os.path.join(self.tmp_dir, "redis_mock.sock")
+        self.address = address
+        self.process = None
+
+    def __serve(self, ready):
+        """
+        Helper function that runs in the owner process, accepting client connections
+        """
+        # Start with a fresh db and lock, since the parent process may have been in the middle of a command when it forked
+        RedisMock.lock = threading.RLock()
+        RedisMock.connection = threading.local()
+        RedisMock.aof = None
+        RedisMock.stream_waiters = {}
+        RedisMock.network_model = None  # the latency is added by the clients
+        flush_db()
+        if self.aof_path is not None:
+            enable_aof(self.aof_path, self.appendfsync)
+        listener = multiprocessing.connection.Listener(self.address, family='AF_UNIX')
+        ready.set()
+        try:
+            while True:
+                conn = listener.accept()
+                thread = threading.Thread(target=self.__serve_connection, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            listener.close()
+
+    def __serve_connection(self, conn):
+        """
+        Helper function that answers the requests of a single client connection.
+        Each connection is served by its own thread, so it gets its own WATCH/MULTI state.
+        """
+        try:
+            while True:
+                request = conn.recv()
+                if request == "FLUSHDB":
+                    flush_db()
+                    conn.send(True)
+                    continue
+                # Like EXEC, an error in one command is returned in its place and doesn't stop the rest of the batch
+                ret = []
+                for args, options in request:
+                    try:
+                        result = execute_command(*args, **options)
+                        if isinstance(result, types.GeneratorType):
+                            result = list(result)  # streamed replies can't be sent over the connection
+                        ret.append(result)
+                    except Exception as e:
+                        ret.append(e)
+                conn.send(ret)
+        except EOFError:
+            pass  # the client hung up
+        finally:
+            conn.close()
+
+    def start(self):
+        """
+        Starts the owner process and waits for it to start listening
+        """
+        if self.process is not None:
+            raise Exception("RedisMockServer is already running on %s" % self.address)
+        ready = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=self.__serve, args=(ready,))
+        self.process.daemon = True
+        self.process.start()
+        while not ready.wait(0.1):
+            if not self.process.is_alive():
+                self.process = None
+                raise Exception("RedisMockServer failed to start on %s" % self.address)
+        return self
+
+    def stop(self):
+        """
+        Stops the owner process. The contents of the db are lost.
+        """
+        if self.process is None:
+            return
+        self.process.terminate()
+        self.process.join()
+        self.process = None
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        if self.tmp_dir is not None:
+            os.rmdir(self.tmp_dir)
+            self.tmp_dir = None
+
+
+class RedisMockClient:
+    """
+    Client for a RedisMockServer. Its execute_command can be used in place of the module's execute_command, e.g.
+    mock_execute_command.side_effect = redis_mock.RedisMockClient(address).execute_command
+
+    Each thread gets its own connection to the server, so WATCH/MULTI state isn't shared between threads.
+    A forked process (e.g. a multiprocessing worker) opens its own connections instead of using its parent's.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.local = threading.local()
+
+    def __get_connection(self):
+        """
+        Helper function to get (or open) the calling thread's connection to the server
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            # A connection inherited from the parent process is left alone, since the parent is still using it
+            conn = multiprocessing.connection.Client(self.address, family='AF_UNIX')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def execute_command(self, *args, **options):
+        """
+        Runs a single command on the server
+        """
+        ret = self.execute_batch([(args, options)])[0]
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+    def execute_batch(self, commands):
+        """
+        Runs a list of (args, options) commands on the server in a single round trip.
+        Returns the list of results. Like EXEC, a command that fails has its exception returned in its place.
+        """
+        commands = [(tuple(args), dict(options)) for args, options in commands]
+        network_model = RedisMock.network_model
+        try:
+            if network_model is not None:
+                delay = network_model.begin_round_trip([args[0] for args, options in commands])
+            conn = self.__get_connection()
+            conn.send(commands)
+            ret = conn.recv()
+            if network_model is not None:
+                network_model.end_round_trip(delay)
+        except redis.exceptions.RedisError:
+            # drop the connection, so the server discards its transaction and watched keys
+            self.close()
+            raise
+        return ret
+
+    def flush_db(self):
+        """
+        Flushes the server's db
+        """
+        conn = self.__get_connection()
+        conn.send("FLUSHDB")
+        return conn.recv()
+
+    def close(self):
+        """
+        Closes the calling thread's connection to the server
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid():
+            conn.close()
+        self.local.conn = None
+
+
+class VirtualClock:
+    """
+    A clock that only moves forward when something sleeps on it, so simulated delays take no real time.
+
+    Each thread has its own virtual time, so the round trips of concurrent threads (e.g. clients sharing a
+    connection pool) overlap like they would on a real network, instead of adding up. A thread starts from the time
+    of the thread that created the clock. That thread catches up to the latest time reached by any thread whenever
+    it uses the clock, so e.g. after joining its worker threads, time() tells how long they took to run concurrently.
+    """
+
+    def __init__(self, start=0.0):
+        self.owner = threading.current_thread()
+        self.owner_now = start
+        self.latest = start  # the latest time reached by any thread
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def __now(self):
+        """
+        Helper function to get the calling thread's virtual time. Must be called with the lock held.
+        """
+        if threading.current_thread() is self.owner:
+            self.owner_now = self.latest
+            return self.owner_now
+        if not hasattr(self.local, 'now'):
+            self.local.now = self.owner_now
+        return self.local.now
+
+    def time(self):
+        """
+        Returns the calling thread's virtual time, in seconds
+        """
+        with self.lock:
+            return self.__now()
+
+    def sleep(self, seconds):
+        """
+        Advances the calling thread's virtual time by seconds, immediately
+        """
+        with self.lock:
+            now = self.__now() + seconds
+            if threading.current_thread() is self.owner:
+                self.owner_now = now
+            else:
+                self.local.now = now
+            if now > self.latest:
+                self.latest = now
+
+
+class RealClock:
+    """
+    A clock that uses the real time, so simulated delays really happen
+    """
+
+    def time(self):
+        """
+        Returns the current time, in seconds
+        """
+        return time.time()
+
+    def sleep(self, seconds):
+        """
+        Sleeps for seconds
+        """
+        time.sleep(seconds)
+
+
+class FixedLatency:
+    """
+    A latency distribution that always takes the same number of seconds
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def sample(self, rand):
+        """
+        Returns the fixed latency, in seconds
+        """
+        return self.seconds
+
+
+class NormalLatency:
+    """
+    A normally distributed latency, in seconds. Negative samples are treated as 0.
+    """
+
+    def __init__(self, mean, stddev):
+        self.mean = mean
+        self.stddev = stddev
+
+    def sample(self, rand):
+        """
+        Returns a latency drawn from the normal distribution with rand, in seconds
+        """
+        return max(0.0, rand.normalvariate(self.mean, self.stddev))
+
+
+class PercentileLatency:
+    """
+    A latency distribution built from recorded percentiles, e.g. {50: 0.001, 99: 0.02, 100: 0.25} (in seconds).
+    Samples are interpolated linearly between the percentiles. Below the lowest percentile, its latency is used.
+    """
+
+    def __init__(self, percentiles):
+        if not percentiles:
+            raise Exception("PercentileLatency needs at least one percentile")
+        self.percentiles = sorted((float(percentile), float(seconds)) for percentile, seconds in percentiles.iteritems())
+        for percentile, seconds in self.percentiles:
+            if percentile < 0 or percentile > 100:
+                raise Exception("Percentiles must be between 0 and 100. percentile: %s" % percentile)
+
+    def sample(self, rand):
+        """
+        Returns a latency drawn from the recorded percentiles with rand, in seconds
+        """
+        percentile = rand.uniform(0, self.percentiles[-1][0])
+        lower_percentile, lower_seconds = self.percentiles[0]
+        if percentile <= lower_percentile:
+            return lower_seconds
+        for upper_percentile, upper_seconds in self.percentiles[1:]:
+            if percentile <= upper_percentile:
+                fraction = (percentile - lower_percentile) / (upper_percentile - lower_percentile)
+                return lower_seconds + fraction * (upper_seconds - lower_seconds)
+            lower_percentile, lower_seconds = upper_percentile, upper_seconds
+        return lower_seconds
+
+
+class NetworkModel:
+    """
+    Models the network between the client and Redis, for use with set_network_model.
+    Every call to execute_command is a round trip, which costs round_trip seconds plus the latency of each command
+    in it (EXEC pays for the commands it queued, and RedisMockClient.execute_batch for the whole batch).
+
+    latencies maps command names to latency distributions (FixedLatency, NormalLatency or PercentileLatency, or just a
+    number of seconds), and default_latency is used for the other commands.
+    If a round trip takes longer than timeout seconds, the command still runs but a redis TimeoutError is raised
+    (after timeout seconds), like a client's socket_timeout.
+    timeout_rate and connection_error_rate are the fractions of round trips that fail with a redis TimeoutError
+    or ConnectionError without running the command.
+    Like a dropped connection, any failure discards the calling thread's transaction and watched keys.
+
+    The delays are slept on the clock, which is a VirtualClock by default so that they take no real time.
+    Use clock.time() and clock.sleep() in your own retry and back off code to keep it on the same clock.
+    Blocking stream reads wait in real time, and the time they spent blocked is added to a VirtualClock.
+    round_trips, timeouts and connection_errors count what has happened so far.
+    """
+
+    def __init__(self, latencies=None, default_latency=None, round_trip=None, timeout=None, timeout_rate=0.0,
+                 connection_error_rate=0.0, clock=None, seed=None):
+        self.latencies = latencies or {}
+        self.default_latency = default_latency
+        self.round_trip = round_trip
+        self.timeout = timeout
+        self.timeout_rate = timeout_rate
+        self.connection_error_rate = connection_error_rate
+        if clock is None:
+            clock = VirtualClock()
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()  # guards the random number generator and the counters
+        self.round_trips = 0
+        self.timeouts = 0
+        self.connection_errors = 0
+
+    def __sample(self, distribution):
+        """
+        Helper function to sample a latency distribution (or a fixed number of seconds)
+        """
+        if distribution is None:
+            return 0.0
+        if isinstance(distribution, ScoreTypes):
+            return float(distribution)
+        return distribution.sample(self.random)
+
+    def begin_round_trip(self, commands):
+        """
+        Starts a round trip for the given commands. Returns how long it will take, or raises the injected failure
+        (after sleeping for however long it takes to notice it).
+        """
+        with self.lock:
+            self.round_trips += 1
+            delay = self.__sample(self.round_trip)
+            for command in commands:
+                delay += self.__sample(self.latencies.get(str(command).upper(), self.default_latency))
+            failure = self.random.random()
+            if failure < self.connection_error_rate:
+                self.connection_errors += 1
+                raise redis.exceptions.ConnectionError("Error connecting to the mock Redis (injected by the NetworkModel)")
+            if failure < self.connection_error_rate + self.timeout_rate:
+                self.timeouts += 1
+                timed_out = True
+            else:
+                timed_out = False
+        if timed_out:
+            self.clock.sleep(self.timeout if self.timeout is not None else delay)
+            raise redis.exceptions.TimeoutError("Timeout reading from socket (injected by the NetworkModel)")
+        return delay
+
+    def end_round_trip(self, delay):
+        """
+        Finishes a round trip that was started with begin_round_trip, once its commands have run
+        """
+        if self.timeout is not None and delay > self.timeout:
+            self.clock.sleep(self.timeout)
+            with self.lock:
+                self.timeouts += 1
+            raise redis.exceptions.TimeoutError("Timeout reading from socket")
+        self.clock.sleep(delay)
@@ -8,11 +8,31 @@ python tests.py
 import redis
 import redis_mock
 import mock
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 redis_c = redis.Redis()  # connect with the defaults (it doesn't matter in the unittest b/c a connection will never be created with the mocks)
 
 
+def add_members_in_process(client, process_num, num_members):
+    """
+    Helper function used to add members to a shared RedisMockServer from another process
+    """
+    for i in xrange(num_members):
+        member = "member%s-%s" % (process_num, i)
+        assert client.execute_command("SADD", "mykey", member) == 1
+        # every process gets a different reply, so a reply meant for another process is noticed
+        assert client.execute_command("SADD", "mykey%s" % process_num, member) == 1
+        assert client.execute_command("SCARD", "mykey%s" % process_num) == i + 1
+    client.close()
+
+
 class RedisMockTest(unittest.TestCase):
 
     def setUp(self):
@@ -51,6 +71,31 @@ class RedisMockTest(unittest.TestCase):
             expected_data.append(("member%s" % i, i))
         self.assertEqual(redis_c.zrange("mykey", 0, -1, withscores=True), expected_data)
 
+        # Test moving a few members, then more members than are moved one at a time, between reads
+        num_members = 10000
+        redis_c.zadd("mykey", *[arg for i in xrange(num_members) for arg in ("member%s" % i, i)])
+        expected_data = [("member%s" % i, i) for i in xrange(num_members)]
+        self.assertEqual(redis_c.zrange("mykey", 0, -1, withscores=True), expected_data)
+        self.assertFalse(redis_c.zadd("mykey", "member0", num_members + 5))
+        self.assertFalse(redis_c.zadd("mykey", "member0", num_members))
+        self.assertTrue(redis_c.zadd("mykey", "member%s" % num_members, -1))
+        expected_data = [("member%s" % num_members, -1)] + expected_data[1:] + [("member0", num_members)]
+        self.assertEqual(redis_c.zrange("mykey", 0, -1, withscores=True), expected_data)
+        num_changes = redis_mock.RedisSortedSetMock.max_changes_to_reorder(num_members + 1) + 1
+        self.assertTrue(0 < num_changes < num_members)
+        redis_c.zadd("mykey", *[arg for i in xrange(num_changes) for arg in ("member%s" % i, -i)])
+        expected_data = ([("member%s" % i, -i) for i in xrange(num_changes - 1, -1, -1)] +
+                         [("member%s" % num_members, -1)] +
+                         [("member%s" % i, i) for i in xrange(num_changes, num_members)])
+        expected_data.sort(key=lambda item: (item[1], item[0]))
+        self.assertEqual(redis_c.zrange("mykey", 0, -1, withscores=True), expected_data)
+
+        # Test that the number of members moved one at a time grows with the size of the sorted set
+        max_changes = [redis_mock.RedisSortedSetMock.max_changes_to_reorder(length)
+                       for length in (0, 10, 1000, 1000000)]
+        self.assertEqual(max_changes[0], 0)
+        self.assertEqual(max_changes, sorted(max_changes))
+
     @mock.patch.object(redis.Redis, 'execute_command')
     def test_zrange(self, mock_execute_command):
         mock_execute_command.side_effect = redis_mock.execute_command
@@ -310,7 +355,12 @@ class RedisMockTest(unittest.TestCase):
         self.assertEqual(len(range), 5)
         self.assertEqual(range, expected_data[:5])
 
-        # TODO: test limit with offset and count
+        # Test limit with offset and count
+        self.assertEqual(redis_c.zrangebyscore("mykey", 2, 7, start=0, num=2, withscores=True), expected_data[2:4])
+        self.assertEqual(redis_c.zrangebyscore("mykey", 2, 7, start=3, num=2, withscores=True), expected_data[5:7])
+        self.assertEqual(redis_c.zrangebyscore("mykey", 2, 7, start=3, num=99, withscores=True), expected_data[5:8])
+        self.assertEqual(redis_c.zrangebyscore("mykey", 2, 7, start=3, num=-1, withscores=True), expected_data[5:8])
+        self.assertEqual(redis_c.zrangebyscore("mykey", 2, 7, start=99, num=2, withscores=True), [])
 
     @mock.patch.object(redis.Redis, 'execute_command')
     def test_zrevrangebyscore(self, mock_execute_command):
@@ -457,7 +507,127 @@ class RedisMockTest(unittest.TestCase):
         self.assertEqual(len(range), 5)
         self.assertEqual(range, expected_data[5:])
 
-        # TODO: test limit with offset and count
+        # Test limit with offset and count
+        self.assertEqual(redis_c.zrevrangebyscore("mykey", 7, 2, start=0, num=2, withscores=True), expected_data[2:4])
+        self.assertEqual(redis_c.zrevrangebyscore("mykey", 7, 2, start=3, num=2, withscores=True), expected_data[5:7])
+        self.assertEqual(redis_c.zrevrangebyscore("mykey", 7, 2, start=3, num=99, withscores=True), expected_data[5:8])
+        self.assertEqual(redis_c.zrevrangebyscore("mykey", 7, 2, start=3, num=-1, withscores=True), expected_data[5:8])
+        self.assertEqual(redis_c.zrevrangebyscore("mykey", 7, 2, start=99, num=2, withscores=True), [])
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_zrange_score_cast_func(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        self.assertTrue(redis_c.zadd("mykey", "member1", 1.5))
+        self.assertTrue(redis_c.zadd("mykey", "member2", 2))
+        self.assertEqual(redis_c.zrange("mykey", 0, -1, withscores=True, score_cast_func=int),
+                         [("member1", 1), ("member2", 2)])
+        self.assertEqual(redis_c.zrevrangebyscore("mykey", "+inf", "-inf", withscores=True, score_cast_func=str),
+                         [("member2", "2.0"), ("member1", "1.5")])
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_zrange_stream(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        # setup enough data to span multiple chunks
+        num_members = redis_mock.RedisSortedSetMock.STREAM_CHUNK_SIZE * 2 + 500
+        expected_data = []
+        for i in xrange(num_members):
+            redis_c.zadd("mykey", "member%s" % i, i)
+            expected_data.append(("member%s" % i, i))
+
+        # Test that streaming returns a generator with the same members as the list
+        stream = redis_c.execute_command("ZRANGE", "mykey", 0, -1, withscores=True, stream=True)
+        self.assertEqual(stream.next(), ("member0", 0))
+        self.assertEqual(list(stream), expected_data[1:])
+        self.assertEqual(list(redis_c.execute_command("ZRANGE", "mykey", 10, -11, stream=True)),
+                         [member for member, score in expected_data[10:-10]])
+        self.assertEqual(list(redis_c.execute_command("ZREVRANGE", "mykey", 0, -1, withscores=True, stream=True)),
+                         expected_data[::-1])
+        self.assertEqual(list(redis_c.execute_command("ZREVRANGE", "mykey", 5, 1500, withscores=True, stream=True)),
+                         expected_data[::-1][5:1501])
+        self.assertEqual(list(redis_c.execute_command("ZRANGEBYSCORE", "mykey", 100, "(2100", withscores=True,
+                                                      stream=True)),
+                         expected_data[100:2100])
+        self.assertEqual(list(redis_c.execute_command("ZREVRANGEBYSCORE", "mykey", 2100, "(100", "LIMIT", 1, 1500,
+                                                      withscores=True, stream=True)),
+                         expected_data[2099:599:-1])
+
+        # Test that the score_cast_func is applied to streamed scores
+        stream = redis_c.execute_command("ZRANGE", "mykey", 0, 2, withscores=True, score_cast_func=str, stream=True)
+        self.assertEqual(list(stream), [("member0", "0.0"), ("member1", "1.0"), ("member2", "2.0")])
+
+        # Test streaming a non-existant key
+        self.assertEqual(list(redis_c.execute_command("ZRANGE", "non_existant_key", 0, -1, stream=True)), [])
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_zrangebylex(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        # setup the data (all with the same score)
+        members = ["a", "b", "c", "d", "e", "f", "g"]
+        for member in reversed(members):
+            redis_c.zadd("mykey", member, 0)
+
+        # Test getting the whole range
+        self.assertEqual(redis_c.zrangebylex("mykey", "-", "+"), members)
+        self.assertEqual(redis_c.zrevrangebylex("mykey", "+", "-"), members[::-1])
+
+        # Test inclusive and exclusive ranges
+        self.assertEqual(redis_c.zrangebylex("mykey", "-", "[c"), ["a", "b", "c"])
+        self.assertEqual(redis_c.zrangebylex("mykey", "-", "(c"), ["a", "b"])
+        self.assertEqual(redis_c.zrangebylex("mykey", "[aaa", "(g"), ["b", "c", "d", "e", "f"])
+        self.assertEqual(redis_c.zrangebylex("mykey", "(b", "+"), ["c", "d", "e", "f", "g"])
+        self.assertEqual(redis_c.zrevrangebylex("mykey", "[c", "-"), ["c", "b", "a"])
+        self.assertEqual(redis_c.zrevrangebylex("mykey", "(g", "[aaa"), ["f", "e", "d", "c", "b"])
+
+        # Test getting invalid or empty ranges
+        self.assertEqual(redis_c.zrangebylex("mykey", "+", "-"), [])
+        self.assertEqual(redis_c.zrangebylex("mykey", "[e", "[c"), [])
+        self.assertEqual(redis_c.zrangebylex("mykey", "(c", "(c"), [])
+        self.assertEqual(redis_c.zrangebylex("mykey", "[h", "+"), [])
+        self.assertEqual(redis_c.zrangebylex("non_existant_key", "-", "+"), [])
+        self.assertRaises(Exception, redis_c.zrangebylex, "mykey", "a", "+")
+
+        # Test limit with offset and count
+        self.assertEqual(redis_c.zrangebylex("mykey", "-", "+", start=1, num=3), ["b", "c", "d"])
+        self.assertEqual(redis_c.zrangebylex("mykey", "[c", "+", start=3, num=99), ["f", "g"])
+        self.assertEqual(redis_c.zrevrangebylex("mykey", "+", "-", start=1, num=3), ["f", "e", "d"])
+
+        # Test prefix lookups
+        redis_mock.flush_db()
+        for term in ["car", "card", "care", "carpet", "cat", "dog"]:
+            redis_c.zadd("mykey", term, 0)
+        self.assertEqual(redis_c.zrangebylex("mykey", "[car", "(cas"), ["car", "card", "care", "carpet"])
+        self.assertEqual(redis_c.zrangebylex("mykey", "[card", "[card\xff"), ["card"])
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_zlexcount(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        for member in ["a", "b", "c", "d", "e", "f", "g"]:
+            redis_c.zadd("mykey", member, 0)
+        self.assertEqual(redis_c.zlexcount("mykey", "-", "+"), 7)
+        self.assertEqual(redis_c.zlexcount("mykey", "[b", "[f"), 5)
+        self.assertEqual(redis_c.zlexcount("mykey", "(b", "(f"), 3)
+        self.assertEqual(redis_c.zlexcount("mykey", "[f", "[b"), 0)
+        self.assertEqual(redis_c.zlexcount("non_existant_key", "-", "+"), 0)
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_zremrangebylex(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        for member in ["aaaa", "b", "c", "d", "e", "foo", "zap", "zip", "ALPHA", "alpha"]:
+            redis_c.zadd("mykey", member, 0)
+        self.assertEqual(redis_c.zremrangebylex("mykey", "[alpha", "[omega"), 6)
+        self.assertEqual(redis_c.zrangebylex("mykey", "-", "+"), ["ALPHA", "aaaa", "zap", "zip"])
+        self.assertEqual(redis_c.zrange("mykey", 0, -1), ["ALPHA", "aaaa", "zap", "zip"])
+        self.assertEqual(redis_c.zremrangebylex("mykey", "[zz", "+"), 0)
+
+        # Test that removing every member deletes the key
+        self.assertEqual(redis_c.zremrangebylex("mykey", "-", "+"), 4)
+        self.assertEqual(redis_mock.RedisMock.db, {})
+        self.assertEqual(redis_c.sadd("mykey", "member1"), 1)
 
     @mock.patch.object(redis.Redis, 'execute_command')
     def test_sadd_and_smembers(self, mock_execute_command):
@@ -529,5 +699,798 @@ class RedisMockTest(unittest.TestCase):
         # Test diff where the 2nd set contains all of the elements in the first set and some extra elements
         self.assertEqual(redis_c.sdiff("mykey1", "mykey7"), set())
 
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_multi_exec(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        # Test that commands are queued until EXEC
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        self.assertEqual(redis_c.sadd("mykey", "member1", "member2"), "QUEUED")
+        self.assertEqual(redis_c.execute_command("SCARD", "mykey"), "QUEUED")
+        self.assertEqual(redis_c.execute_command("EXEC"), [2, 2])
+
+        # Test that DISCARD drops the queued commands
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        self.assertEqual(redis_c.sadd("mykey", "member3"), "QUEUED")
+        self.assertTrue(redis_c.execute_command("DISCARD"))
+        self.assertEqual(redis_c.scard("mykey"), 2)
+
+        # Test invalid transaction commands
+        self.assertRaises(Exception, redis_c.execute_command, "EXEC")
+        self.assertRaises(Exception, redis_c.execute_command, "DISCARD")
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        self.assertRaises(Exception, redis_c.execute_command, "MULTI")
+        self.assertRaises(Exception, redis_c.execute_command, "WATCH", "mykey")
+        self.assertTrue(redis_c.execute_command("DISCARD"))
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_watch(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        self.assertTrue(redis_c.zadd("mykey", "member1", 1))
+
+        # Test a transaction with an unmodified watched key
+        self.assertTrue(redis_c.execute_command("WATCH", "mykey", "non_existant_key"))
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        redis_c.zadd("mykey", "member2", 2)
+        self.assertEqual(redis_c.execute_command("EXEC"), [True])
+
+        # Test that modifying a watched key aborts the transaction
+        self.assertTrue(redis_c.execute_command("WATCH", "mykey"))
+        self.assertTrue(redis_c.zadd("mykey", "member3", 3))
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        redis_c.zadd("mykey", "member4", 4)
+        self.assertEqual(redis_c.execute_command("EXEC"), None)
+        self.assertEqual(redis_c.zrange("mykey", 0, -1), ["member1", "member2", "member3"])
+
+        # Test that creating a watched key aborts the transaction
+        self.assertTrue(redis_c.execute_command("WATCH", "myset"))
+        self.assertEqual(redis_c.sadd("myset", "member1"), 1)
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        self.assertEqual(redis_c.execute_command("EXEC"), None)
+
+        # Test that a ZADD with a bad pair doesn't add any of its members, so it doesn't abort the transaction
+        self.assertTrue(redis_c.execute_command("WATCH", "mykey"))
+        self.assertRaises(Exception, redis_c.execute_command, "ZADD", "mykey", 5, "member5", "x", "member6")
+        self.assertRaises(Exception, redis_c.execute_command, "ZADD", "mykey", 5, "member5", 6)
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        self.assertEqual(redis_c.execute_command("EXEC"), [])
+        self.assertEqual(redis_c.zrange("mykey", 0, -1), ["member1", "member2", "member3"])
+
+        # Test that a write which doesn't change the key doesn't abort the transaction
+        self.assertTrue(redis_c.execute_command("WATCH", "myset"))
+        self.assertEqual(redis_c.sadd("myset", "member1"), 0)
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        self.assertEqual(redis_c.execute_command("EXEC"), [])
+
+        # Test that UNWATCH forgets the watched keys
+        self.assertTrue(redis_c.execute_command("WATCH", "myset"))
+        self.assertEqual(redis_c.sadd("myset", "member2"), 1)
+        self.assertTrue(redis_c.execute_command("UNWATCH"))
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        self.assertEqual(redis_c.execute_command("EXEC"), [])
+
+        # Test that flushing the db discards the transaction and the watched keys
+        self.assertTrue(redis_c.execute_command("WATCH", "myset"))
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        self.assertEqual(redis_c.sadd("myset", "member1"), "QUEUED")
+        redis_mock.flush_db()
+        self.assertEqual(redis_c.sadd("myset", "member1"), 1)
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        self.assertEqual(redis_c.execute_command("EXEC"), [])
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_watch_contention(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        num_threads = 8
+        num_increments = 50
+        retries = []
+
+        def increment():
+            # Optimistically add the next member to the sorted set, retrying if another thread got there first
+            for i in xrange(num_increments):
+                while True:
+                    redis_c.execute_command("WATCH", "mykey")
+                    next_score = len(redis_c.zrange("mykey", 0, -1))
+                    redis_c.execute_command("MULTI")
+                    redis_c.zadd("mykey", "member%s" % next_score, next_score)
+                    if redis_c.execute_command("EXEC") is not None:
+                        break
+                    retries.append(1)
+
+        threads = [threading.Thread(target=increment) for i in xrange(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every member should have been added exactly once, no matter how many retries there were
+        expected_data = [("member%s" % i, i) for i in xrange(num_threads * num_increments)]
+        self.assertEqual(redis_c.zrange("mykey", 0, -1, withscores=True), expected_data)
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_shared_server(self, mock_execute_command):
+        server = redis_mock.RedisMockServer().start()
+        try:
+            client = redis_mock.RedisMockClient(server.address)
+            mock_execute_command.side_effect = client.execute_command
+
+            # Test that commands and errors go through the client
+            self.assertEqual(redis_c.sadd("myset", "member1", "member2"), 2)
+            self.assertEqual(redis_c.smembers("myset"), set(["member1", "member2"]))
+            self.assertRaises(Exception, redis_c.zadd, "myset", "member1", 1)
+
+            # Test that the local db isn't used
+            self.assertEqual(redis_mock.RedisMock.db, {})
+
+            # Test batching multiple commands in a single round trip
+            ret = client.execute_batch([(("SADD", "myset", "member3"), {}),
+                                        (("ZADD", "myset", 1, "member1"), {}),
+                                        (("SCARD", "myset"), {})])
+            self.assertEqual(ret[0], 1)
+            self.assertTrue(isinstance(ret[1], Exception))
+            self.assertEqual(ret[2], 3)
+
+            # Test that a batch is a single round trip for the network model
+            network_model = redis_mock.NetworkModel(default_latency=0.001, round_trip=0.01)
+            redis_mock.set_network_model(network_model)
+            self.addCleanup(redis_mock.set_network_model, None)
+            client.execute_batch([(("SCARD", "myset"), {})] * 3)
+            self.assertEqual(network_model.round_trips, 1)
+            self.assertAlmostEqual(network_model.clock.time(), 0.013)
+            redis_mock.set_network_model(None)
+
+            # Test that multiple processes share the same db, even when they're forked with the client connected
+            num_processes = 4
+            num_members = 100
+            processes = [multiprocessing.Process(target=add_members_in_process, args=(client, i, num_members))
+                         for i in xrange(num_processes)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join(30)
+                self.assertFalse(process.is_alive())
+                self.assertEqual(process.exitcode, 0)
+            self.assertEqual(redis_c.scard("myset"), 3)
+            self.assertEqual(redis_c.scard("mykey"), num_processes * num_members)
+
+            # Test flushing the shared db
+            self.assertTrue(client.flush_db())
+            self.assertEqual(redis_c.scard("mykey"), 0)
+            client.close()
+        finally:
+            server.stop()
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_aof(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.addCleanup(redis_mock.disable_aof)
+        aof_path = os.path.join(tmp_dir, "redis_mock.aof")
+
+        for appendfsync in ("always", "everysec", "no"):
+            redis_mock.flush_db()
+            if os.path.exists(aof_path):
+                os.remove(aof_path)
+
+            # Test that write commands are replayed
+            redis_mock.enable_aof(aof_path, appendfsync)
+            self.assertEqual(redis_c.sadd("myset", "member1", "member2"), 2)
+            self.assertTrue(redis_c.zadd("mykey", "member1", 1))
+            self.assertRaises(Exception, redis_c.sadd, "mykey", "member1")
+            redis_mock.disable_aof()
+            redis_mock.flush_db()
+            self.assertEqual(redis_c.scard("myset"), 0)
+            redis_mock.enable_aof(aof_path, appendfsync)
+            self.assertEqual(redis_c.smembers("myset"), set(["member1", "member2"]))
+            self.assertEqual(redis_c.zrange("mykey", 0, -1, withscores=True), [("member1", 1)])
+
+            # Test that flush_db and transactions are replayed
+            redis_mock.flush_db()
+            self.assertTrue(redis_c.execute_command("MULTI"))
+            redis_c.sadd("myset", "member3")
+            redis_c.zadd("mykey", "member2", 2)
+            self.assertEqual(redis_c.execute_command("EXEC"), [1, True])
+            redis_mock.disable_aof()
+            redis_mock.flush_db()
+            redis_mock.enable_aof(aof_path, appendfsync)
+            self.assertEqual(redis_c.smembers("myset"), set(["member3"]))
+            self.assertEqual(redis_c.zrange("mykey", 0, -1, withscores=True), [("member2", 2)])
+            redis_mock.disable_aof()
+            redis_mock.flush_db()
+
+        # Test that a partially written record at the end of the file is truncated
+        with open(aof_path, 'ab') as f:
+            f.write("\x80\x02(")
+        redis_mock.enable_aof(aof_path)
+        self.assertEqual(redis_c.smembers("myset"), set(["member3"]))
+        self.assertEqual(redis_c.sadd("myset", "member4"), 1)
+        redis_mock.disable_aof()
+        redis_mock.flush_db()
+        redis_mock.enable_aof(aof_path)
+        self.assertEqual(redis_c.smembers("myset"), set(["member3", "member4"]))
+
+        # Test that rewriting the file compacts it without losing anything
+        for i in xrange(2000):
+            redis_c.zadd("mykey", "member%s" % (i % 1500), i)
+        redis_c.pfadd("myhll", *["member%s" % i for i in xrange(500)])
+        expected_count = redis_c.pfcount("myhll")
+        aof_size = os.path.getsize(aof_path)
+        redis_mock.rewrite_aof().join()
+        self.assertTrue(os.path.getsize(aof_path) < aof_size)
+        self.assertEqual(redis_c.sadd("myset", "member5"), 1)
+        expected_data = redis_c.zrange("mykey", 0, -1, withscores=True)
+
+        # Test that generated stream ids are replayed as they were generated
+        redis_c.execute_command("XADD", "mystream", "*", "field1", "value1")
+        redis_c.execute_command("XGROUP", "CREATE", "mystream", "mygroup", "0")
+        redis_c.execute_command("XREADGROUP", "GROUP", "mygroup", "consumer1", "STREAMS", "mystream", ">")
+        redis_c.execute_command("XADD", "mystream", "MAXLEN", 5, "*", "field1", "value2")
+        expected_entries = redis_c.execute_command("XRANGE", "mystream", "-", "+")
+        expected_pending = redis_c.execute_command("XPENDING", "mystream", "mygroup")
+        redis_mock.disable_aof()
+        redis_mock.flush_db()
+        redis_mock.enable_aof(aof_path)
+        self.assertEqual(redis_c.smembers("myset"), set(["member3", "member4", "member5"]))
+        self.assertEqual(redis_c.zrange("mykey", 0, -1, withscores=True), expected_data)
+        self.assertEqual(redis_c.pfcount("myhll"), expected_count)
+        self.assertEqual(redis_c.execute_command("XRANGE", "mystream", "-", "+"), expected_entries)
+        self.assertEqual(redis_c.execute_command("XPENDING", "mystream", "mygroup"), expected_pending)
+
+        # Test that replaying doesn't go through the network model or the calling thread's transaction
+        redis_mock.disable_aof()
+        redis_mock.flush_db()
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        redis_mock.set_network_model(redis_mock.NetworkModel(connection_error_rate=1.0))
+        self.addCleanup(redis_mock.set_network_model, None)
+        redis_mock.enable_aof(aof_path)
+        redis_mock.set_network_model(None)
+        self.assertEqual(redis_c.execute_command("EXEC"), [])
+        self.assertEqual(redis_c.smembers("myset"), set(["member3", "member4", "member5"]))
+
+    def set_bitmap(self, key, value):
+        """
+        Helper function to set a bitmap to a string, one byte at a time
+        """
+        args = []
+        for i, char in enumerate(value):
+            args.extend(["SET", "u8", "#%s" % i, ord(char)])
+        redis_c.execute_command("BITFIELD", key, *args)
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_setbit_and_getbit(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        self.assertEqual(redis_c.getbit("mykey", 7), 0)
+        self.assertEqual(redis_c.setbit("mykey", 7, 1), 0)
+        self.assertEqual(redis_c.getbit("mykey", 0), 0)
+        self.assertEqual(redis_c.getbit("mykey", 7), 1)
+        self.assertEqual(redis_c.getbit("mykey", 100), 0)
+        self.assertEqual(redis_mock.RedisMock.db["mykey"].bytes, bytearray("\x01"))
+
+        # Test that setting a bit past the end grows the bitmap
+        self.assertEqual(redis_c.setbit("mykey", 17, 1), 0)
+        self.assertEqual(redis_mock.RedisMock.db["mykey"].bytes, bytearray("\x01\x00\x40"))
+        self.assertEqual(redis_c.setbit("mykey", 17, 0), 1)
+        self.assertEqual(redis_c.getbit("mykey", 17), 0)
+
+        # Test invalid arguments
+        self.assertRaises(Exception, redis_c.setbit, "mykey", -1, 1)
+        self.assertRaises(Exception, redis_c.setbit, "mykey", 2 ** 32, 1)
+        self.assertRaises(Exception, redis_c.execute_command, "SETBIT", "mykey", 1, 2)
+        self.assertEqual(redis_c.sadd("myset", "member1"), 1)
+        self.assertRaises(Exception, redis_c.setbit, "myset", 1, 1)
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_bitcount(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        self.assertEqual(redis_c.bitcount("non_existant_key"), 0)
+        self.set_bitmap("mykey", "foobar")
+        self.assertEqual(redis_c.bitcount("mykey"), 26)
+        self.assertEqual(redis_c.bitcount("mykey", 0, 0), 4)
+        self.assertEqual(redis_c.bitcount("mykey", 1, 1), 6)
+        self.assertEqual(redis_c.bitcount("mykey", -2, -1), 7)
+        self.assertEqual(redis_c.bitcount("mykey", 2, 1), 0)
+        self.assertEqual(redis_c.bitcount("mykey", 0, 999), 26)
+
+        # Test a bitmap that spans multiple chunks
+        for i in xrange(0, 200000, 3):
+            redis_c.setbit("mybitmap", i, 1)
+        self.assertEqual(redis_c.bitcount("mybitmap"), len(xrange(0, 200000, 3)))
+        self.assertEqual(redis_c.bitcount("mybitmap", 10000, -1), len(xrange(80001, 200000, 3)))
+
+        # Test a bitmap of all 1s that spans multiple chunks, where every chunk has its largest possible count
+        num_bytes = redis_mock.RedisBitmapMock.POPCOUNT_CHUNK_SIZE * 3 + 5
+        redis_c.setbit("myzeros", num_bytes * 8 - 1, 0)
+        redis_c.bitop("NOT", "myones", "myzeros")
+        self.assertEqual(redis_c.bitcount("myones"), num_bytes * 8)
+        self.assertEqual(redis_c.bitcount("myones", 1, -2), (num_bytes - 2) * 8)
+
+        # Test that start without end is a syntax error
+        self.assertRaises(Exception, redis_c.execute_command, "BITCOUNT", "mykey", 0)
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_bitpos(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        self.assertEqual(redis_c.bitpos("non_existant_key", 0), 0)
+        self.assertEqual(redis_c.bitpos("non_existant_key", 1), -1)
+
+        self.set_bitmap("mykey", "\xff\xf0\x00")
+        self.assertEqual(redis_c.bitpos("mykey", 0), 12)
+        self.set_bitmap("mykey", "\x00\xff\xf0")
+        self.assertEqual(redis_c.bitpos("mykey", 1, 0), 8)
+        self.assertEqual(redis_c.bitpos("mykey", 1, 2), 16)
+        self.assertEqual(redis_c.bitpos("mykey", 1, 2, -1), 16)
+        self.assertEqual(redis_c.bitpos("mykey", 0, 1, 1), -1)
+        self.assertEqual(redis_c.bitpos("mykey", 1, 2, 1), -1)
+        self.set_bitmap("mykey", "\x00\x00\x00")
+        self.assertEqual(redis_c.bitpos("mykey", 1), -1)
+
+        # Test that the bits past the end are treated as 0s, unless an end is given
+        self.set_bitmap("myfull", "\xff\xff\xff")
+        self.assertEqual(redis_c.bitpos("myfull", 0), 24)
+        self.assertEqual(redis_c.bitpos("myfull", 0, 1), 24)
+        self.assertEqual(redis_c.bitpos("myfull", 0, 0, -1), -1)
+        self.assertRaises(Exception, redis_c.bitpos, "myfull", 2)
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_bitop(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        self.set_bitmap("key1", "foobar")
+        self.set_bitmap("key2", "abcdef")
+        self.assertEqual(redis_c.bitop("AND", "dest", "key1", "key2"), 6)
+        self.assertEqual(redis_mock.RedisMock.db["dest"].bytes, bytearray("`bc`ab"))
+        self.assertEqual(redis_c.bitop("OR", "dest", "key1", "key2"), 6)
+        self.assertEqual(redis_mock.RedisMock.db["dest"].bytes, bytearray("goofev"))
+        self.assertEqual(redis_c.bitop("XOR", "dest", "key1", "key2"), 6)
+        self.assertEqual(redis_mock.RedisMock.db["dest"].bytes, bytearray("\x07\r\x0c\x06\x04\x14"))
+        self.assertEqual(redis_c.bitop("NOT", "dest", "key1"), 6)
+        self.assertEqual(redis_mock.RedisMock.db["dest"].bytes, bytearray(chr(~ord(c) & 0xff) for c in "foobar"))
+
+        # Test that shorter and missing bitmaps are padded with 0s
+        self.set_bitmap("key3", "\xff")
+        self.assertEqual(redis_c.bitop("OR", "dest", "key3", "key1"), 6)
+        self.assertEqual(redis_mock.RedisMock.db["dest"].bytes, bytearray("\xffoobar"))
+        self.assertEqual(redis_c.bitop("AND", "dest", "key3", "key1"), 6)
+        self.assertEqual(redis_mock.RedisMock.db["dest"].bytes, bytearray("f\x00\x00\x00\x00\x00"))
+        self.assertEqual(redis_c.bitop("AND", "dest", "key1", "non_existant_key"), 6)
+        self.assertEqual(redis_mock.RedisMock.db["dest"].bytes, bytearray(6))
+
+        # Test that an empty result deletes the destination
+        self.assertEqual(redis_c.bitop("OR", "dest", "non_existant_key"), 0)
+        self.assertTrue("dest" not in redis_mock.RedisMock.db)
+
+        # Test invalid operations
+        self.assertRaises(Exception, redis_c.bitop, "NOT", "dest", "key1", "key2")
+        self.assertRaises(Exception, redis_c.bitop, "NAND", "dest", "key1", "key2")
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_bitfield(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        # Test get, set and incrby
+        self.assertEqual(redis_c.execute_command("BITFIELD", "mykey", "INCRBY", "i5", 100, 1, "GET", "u4", 0), [1, 0])
+        self.assertEqual(redis_c.execute_command("BITFIELD", "mykey", "SET", "i8", "#1", -100, "GET", "i8", 8,
+                                                 "GET", "u8", "#1"),
+                         [0, -100, 156])
+        self.assertEqual(redis_c.execute_command("BITFIELD", "mykey", "SET", "u16", 3, 65535, "GET", "u16", 3),
+                         [0x4e0, 65535])
+        self.assertEqual(redis_c.execute_command("BITFIELD", "mykey", "GET", "i64", 0, "GET", "u8", 1000),
+                         [0x1fffe0 << 40, 0])
+
+        # Test the overflow behaviors
+        results = []
+        for i in xrange(4):
+            results.append(redis_c.execute_command("BITFIELD", "myoverflow", "INCRBY", "u2", 100, 1,
+                                                   "OVERFLOW", "SAT", "INCRBY", "u2", 102, 1))
+        self.assertEqual(results, [[1, 1], [2, 2], [3, 3], [0, 3]])
+        self.assertEqual(redis_c.execute_command("BITFIELD", "myoverflow", "OVERFLOW", "FAIL", "INCRBY", "u2", 102, 1),
+                         [None])
+        self.assertEqual(redis_c.execute_command("BITFIELD", "myoverflow", "OVERFLOW", "SAT", "SET", "i4", 0, -100,
+                                                 "GET", "i4", 0),
+                         [0, -8])
+        self.assertEqual(redis_c.execute_command("BITFIELD", "myoverflow", "SET", "i4", 0, 9, "GET", "i4", 0),
+                         [-8, -7])
+
+        # Test that a GET doesn't create the key
+        self.assertEqual(redis_c.execute_command("BITFIELD", "non_existant_key", "GET", "u8", 0), [0])
+        self.assertTrue("non_existant_key" not in redis_mock.RedisMock.db)
+
+        # Test invalid arguments
+        self.assertRaises(Exception, redis_c.execute_command, "BITFIELD", "mykey", "GET", "u64", 0)
+        self.assertRaises(Exception, redis_c.execute_command, "BITFIELD", "mykey", "GET", "x8", 0)
+        self.assertRaises(Exception, redis_c.execute_command, "BITFIELD", "mykey", "OVERFLOW", "NOPE")
+        self.assertRaises(Exception, redis_c.execute_command, "BITFIELD", "mykey", "SET", "u8", 0)
+
+        # Test that a bad subcommand after a valid write doesn't write anything
+        self.set_bitmap("mybitmap", "\x01")
+        self.assertTrue(redis_c.execute_command("WATCH", "mybitmap"))
+        self.assertRaises(Exception, redis_c.execute_command, "BITFIELD", "mybitmap", "SET", "u8", 0, 255, "BOGUS")
+        self.assertRaises(Exception, redis_c.execute_command, "BITFIELD", "mybitmap", "INCRBY", "u8", 0, 1,
+                          "SET", "u8", 8, "x")
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        self.assertEqual(redis_c.execute_command("EXEC"), [])
+        self.assertEqual(redis_c.execute_command("BITFIELD", "mybitmap", "GET", "u16", 0), [0x100])
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_xadd_and_xrange(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        # Test adding with explicit ids
+        self.assertEqual(redis_c.execute_command("XADD", "mystream", "1-1", "field1", "value1"), "1-1")
+        self.assertEqual(redis_c.execute_command("XADD", "mystream", "1-2", "field1", "value2", "field2", "value3"), "1-2")
+        self.assertEqual(redis_c.execute_command("XADD", "mystream", "5", "field1", "value4"), "5-0")
+        self.assertRaises(Exception, redis_c.execute_command, "XADD", "mystream", "5-0", "field1", "value5")
+        self.assertRaises(Exception, redis_c.execute_command, "XADD", "mystream", "4-0", "field1", "value5")
+        self.assertRaises(Exception, redis_c.execute_command, "XADD", "mystream", "6-0", "field1")
+        self.assertEqual(redis_c.execute_command("XLEN", "mystream"), 3)
+
+        # Test that generated ids are always increasing
+        ids = [redis_c.execute_command("XADD", "mystream", "*", "field1", "value%s" % i) for i in xrange(100)]
+        parsed_ids = [redis_mock.RedisStreamMock.parse_id(entry_id) for entry_id in ids]
+        self.assertEqual(parsed_ids, sorted(set(parsed_ids)))
+        self.assertTrue(parsed_ids[0] > (5, 0))
+
+        # Test ranges
+        expected_data = [("1-1", {"field1": "value1"}), ("1-2", {"field1": "value2", "field2": "value3"}),
+                         ("5-0", {"field1": "value4"})]
+        self.assertEqual(redis_c.execute_command("XRANGE", "mystream", "-", "5"), expected_data)
+        self.assertEqual(redis_c.execute_command("XRANGE", "mystream", "1", "1"), expected_data[:2])
+        self.assertEqual(redis_c.execute_command("XRANGE", "mystream", "1-2", "5-0"), expected_data[1:])
+        self.assertEqual(redis_c.execute_command("XRANGE", "mystream", "(1-1", "(5-0"), expected_data[1:2])
+        self.assertEqual(redis_c.execute_command("XRANGE", "mystream", "-", "+", "COUNT", 2), expected_data[:2])
+        self.assertEqual(redis_c.execute_command("XRANGE", "mystream", "6", "1"), [])
+        self.assertEqual(redis_c.execute_command("XREVRANGE", "mystream", "5", "-"), expected_data[::-1])
+        self.assertEqual(redis_c.execute_command("XREVRANGE", "mystream", "5", "-", "COUNT", 2), expected_data[:0:-1])
+        self.assertEqual(len(redis_c.execute_command("XRANGE", "mystream", "-", "+")), 103)
+        self.assertEqual(redis_c.execute_command("XRANGE", "non_existant_key", "-", "+"), [])
+        self.assertRaises(Exception, redis_c.execute_command, "XRANGE", "mystream", "abc", "+")
+
+        # Test trimming
+        last_id = redis_c.execute_command("XADD", "mystream", "MAXLEN", "~", 50, "*", "field1", "value")
+        self.assertEqual(redis_c.execute_command("XLEN", "mystream"), 50)
+        self.assertEqual(redis_c.execute_command("XRANGE", "mystream", "-", "+")[0][0], ids[-49])
+        self.assertEqual(redis_c.execute_command("XTRIM", "mystream", "MAXLEN", 10), 40)
+        self.assertEqual(redis_c.execute_command("XTRIM", "mystream", "MAXLEN", 10), 0)
+        self.assertEqual([entry_id for entry_id, fields in redis_c.execute_command("XRANGE", "mystream", "-", "+")],
+                         ids[-9:] + [last_id])
+        self.assertEqual(redis_c.execute_command("XRANGE", "mystream", "-", "1-2"), [])
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_xread(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        redis_c.execute_command("XADD", "mystream1", "1-1", "field1", "value1")
+        redis_c.execute_command("XADD", "mystream1", "1-2", "field1", "value2")
+        redis_c.execute_command("XADD", "mystream2", "2-1", "field1", "value3")
+
+        # Test reading from multiple streams
+        self.assertEqual(redis_c.execute_command("XREAD", "STREAMS", "mystream1", "mystream2", "0", "0"),
+                         [["mystream1", [("1-1", {"field1": "value1"}), ("1-2", {"field1": "value2"})]],
+                          ["mystream2", [("2-1", {"field1": "value3"})]]])
+        self.assertEqual(redis_c.execute_command("XREAD", "COUNT", 1, "STREAMS", "mystream1", "non_existant_key", "1-1", "0"),
+                         [["mystream1", [("1-2", {"field1": "value2"})]]])
+        self.assertEqual(redis_c.execute_command("XREAD", "STREAMS", "mystream1", "mystream2", "$", "$"), None)
+        self.assertRaises(Exception, redis_c.execute_command, "XREAD", "STREAMS", "mystream1", "mystream2", "0")
+
+        # Test that a blocked read times out
+        self.assertEqual(redis_c.execute_command("XREAD", "BLOCK", 10, "STREAMS", "mystream1", "$"), None)
+
+        # Test that a blocked read is woken up by XADD from another connection
+        def add_entry():
+            time.sleep(0.05)
+            redis_c.execute_command("XADD", "mystream2", "3-1", "field1", "value4")
+        thread = threading.Thread(target=add_entry)
+        thread.start()
+        self.assertEqual(redis_c.execute_command("XREAD", "BLOCK", 0, "STREAMS", "mystream1", "mystream2", "$", "$"),
+                         [["mystream2", [("3-1", {"field1": "value4"})]]])
+        thread.join()
+        self.assertEqual(redis_mock.RedisMock.stream_waiters, {})
+
+        # Test that a read blocked with a timeout is woken up by XADD right away, instead of on a polling interval
+        wake_delays = []
+        for i in xrange(5):
+            added_at = []
+
+            def add_entry():
+                time.sleep(0.1)
+                added_at.append(time.time())
+                redis_c.execute_command("XADD", "mystream2", "*", "field1", "value5")
+            thread = threading.Thread(target=add_entry)
+            thread.start()
+            self.assertTrue(redis_c.execute_command("XREAD", "BLOCK", 5000, "STREAMS", "mystream2", "$"))
+            wake_delays.append(time.time() - added_at[0])
+            thread.join()
+        self.assertTrue(min(wake_delays) < 0.01, wake_delays)
+        self.assertEqual(redis_mock.RedisMock.stream_waiters, {})
+
+        # Test that reads in a transaction never block
+        redis_c.execute_command("MULTI")
+        redis_c.execute_command("XREAD", "BLOCK", 0, "STREAMS", "mystream1", "$")
+        self.assertEqual(redis_c.execute_command("EXEC"), [None])
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_xreadgroup(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        # Test creating groups
+        self.assertRaises(Exception, redis_c.execute_command, "XGROUP", "CREATE", "mystream", "mygroup", "$")
+        self.assertRaises(Exception, redis_c.execute_command, "XGROUP", "CREATE", "mystream", "mygroup", "bad-id",
+                          "MKSTREAM")
+        self.assertTrue("mystream" not in redis_mock.RedisMock.db)
+        self.assertTrue(redis_c.execute_command("XGROUP", "CREATE", "mystream", "mygroup", "$", "MKSTREAM"))
+        self.assertRaises(Exception, redis_c.execute_command, "XGROUP", "CREATE", "mystream", "mygroup", "$")
+        self.assertRaises(Exception, redis_c.execute_command, "XREADGROUP", "GROUP", "nogroup", "consumer1",
+                          "STREAMS", "mystream", ">")
+
+        for i in xrange(1, 6):
+            redis_c.execute_command("XADD", "mystream", "%s-0" % i, "field1", "value%s" % i)
+
+        # Test that new entries are delivered to one consumer at a time
+        self.assertEqual(redis_c.execute_command("XREADGROUP", "GROUP", "mygroup", "consumer1", "COUNT", 2,
+                                                 "STREAMS", "mystream", ">"),
+                         [["mystream", [("1-0", {"field1": "value1"}), ("2-0", {"field1": "value2"})]]])
+        self.assertEqual(redis_c.execute_command("XREADGROUP", "GROUP", "mygroup", "consumer2", "COUNT", 1,
+                                                 "STREAMS", "mystream", ">"),
+                         [["mystream", [("3-0", {"field1": "value3"})]]])
+        pending = redis_c.execute_command("XPENDING", "mystream", "mygroup")
+        self.assertEqual(pending, {'pending': 3, 'min': "1-0", 'max': "3-0",
+                                   'consumers': [{'name': "consumer1", 'pending': 2},
+                                                 {'name': "consumer2", 'pending': 1}]})
+
+        # Test reading a consumer's pending entries again
+        self.assertEqual(redis_c.execute_command("XREADGROUP", "GROUP", "mygroup", "consumer1", "STREAMS", "mystream", "0"),
+                         [["mystream", [("1-0", {"field1": "value1"}), ("2-0", {"field1": "value2"})]]])
+        self.assertEqual(redis_c.execute_command("XREADGROUP", "GROUP", "mygroup", "consumer1", "STREAMS", "mystream", "1-0"),
+                         [["mystream", [("2-0", {"field1": "value2"})]]])
+        pending = redis_c.execute_command("XPENDING", "mystream", "mygroup", "-", "+", 10, "consumer1")
+        self.assertEqual([entry['message_id'] for entry in pending], ["1-0", "2-0"])
+        self.assertEqual([entry['times_delivered'] for entry in pending], [2, 3])
+
+        # Test acknowledging entries
+        self.assertEqual(redis_c.execute_command("XACK", "mystream", "mygroup", "1-0", "3-0", "9-0"), 2)
+        self.assertEqual(redis_c.execute_command("XACK", "mystream", "mygroup", "1-0"), 0)
+        self.assertEqual(redis_c.execute_command("XPENDING", "mystream", "mygroup")['pending'], 1)
+        self.assertEqual(redis_c.execute_command("XREADGROUP", "GROUP", "mygroup", "consumer2", "STREAMS", "mystream", "0"),
+                         [["mystream", []]])
+
+        # Test NOACK
+        self.assertEqual(redis_c.execute_command("XREADGROUP", "GROUP", "mygroup", "consumer2", "NOACK",
+                                                 "STREAMS", "mystream", ">"),
+                         [["mystream", [("4-0", {"field1": "value4"}), ("5-0", {"field1": "value5"})]]])
+        self.assertEqual(redis_c.execute_command("XPENDING", "mystream", "mygroup")['pending'], 1)
+        self.assertEqual(redis_c.execute_command("XREADGROUP", "GROUP", "mygroup", "consumer2",
+                                                 "STREAMS", "mystream", ">"), None)
+
+        # Test that a blocked group read is woken up by XADD
+        def add_entry():
+            time.sleep(0.05)
+            redis_c.execute_command("XADD", "mystream", "6-0", "field1", "value6")
+        thread = threading.Thread(target=add_entry)
+        thread.start()
+        self.assertEqual(redis_c.execute_command("XREADGROUP", "GROUP", "mygroup", "consumer1", "BLOCK", 5000,
+                                                 "STREAMS", "mystream", ">"),
+                         [["mystream", [("6-0", {"field1": "value6"})]]])
+        thread.join()
+
+        # Test that trimmed pending entries are returned without their fields
+        redis_c.execute_command("XTRIM", "mystream", "MAXLEN", 0)
+        self.assertEqual(redis_c.execute_command("XREADGROUP", "GROUP", "mygroup", "consumer1", "STREAMS", "mystream", "0"),
+                         [["mystream", [("2-0", None), ("6-0", None)]]])
+
+        # Test destroying the group
+        self.assertEqual(redis_c.execute_command("XGROUP", "DESTROY", "mystream", "mygroup"), 1)
+        self.assertEqual(redis_c.execute_command("XGROUP", "DESTROY", "mystream", "mygroup"), 0)
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_pfadd_and_pfcount(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        # Test edge cases
+        self.assertEqual(redis_c.pfcount("non_existant_key"), 0)
+        self.assertEqual(redis_c.pfadd("myhll"), 1)
+        self.assertEqual(redis_c.pfcount("myhll"), 0)
+
+        # Test small counts, which should be exact
+        self.assertEqual(redis_c.pfadd("myhll", "a", "b", "c", "d", "e", "f", "g"), 1)
+        self.assertEqual(redis_c.pfcount("myhll"), 7)
+        self.assertEqual(redis_c.pfadd("myhll", "a", "b"), 0)
+        self.assertEqual(redis_c.pfcount("myhll"), 7)
+
+        # Test that the registers switch from sparse to dense, and the count stays within Redis's error bounds
+        self.assertTrue(redis_mock.RedisMock.db["myhll"].sparse is not None)
+        redis_c.pfadd("myhll", *["member%s" % j for j in xrange(0, 500)])
+        self.assertTrue(redis_mock.RedisMock.db["myhll"].sparse is not None)
+        for i in xrange(0, 20000, 1000):
+            redis_c.pfadd("myhll", *["member%s" % j for j in xrange(i, i + 1000)])
+        self.assertTrue(redis_mock.RedisMock.db["myhll"].sparse is None)
+        self.assertTrue(abs(redis_c.pfcount("myhll") - 20007) < 20007 * 0.03)
+
+        # Test that calling PFADD on a key of another type fails
+        self.assertEqual(redis_c.sadd("myset", "member1"), 1)
+        self.assertRaises(Exception, redis_c.pfadd, "myset", "member1")
+        self.assertRaises(Exception, redis_c.pfcount, "myset")
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_pfmerge(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+
+        # setup one sparse and two dense HyperLogLogs, with overlapping members
+        redis_c.pfadd("myhll1", "a", "b", "c")
+        redis_c.pfadd("myhll2", *["member%s" % i for i in xrange(0, 6000)])
+        redis_c.pfadd("myhll3", *["member%s" % i for i in xrange(4000, 10000)])
+
+        # Test counting multiple keys without modifying them
+        count = redis_c.pfcount("myhll1", "myhll2", "myhll3", "non_existant_key")
+        self.assertTrue(abs(count - 10003) < 10003 * 0.03)
+        self.assertEqual(redis_c.pfcount("myhll1"), 3)
+
+        # Test merging into a new key
+        self.assertTrue(redis_c.pfmerge("mydest", "myhll1", "myhll2", "myhll3", "non_existant_key"))
+        self.assertEqual(redis_c.pfcount("mydest"), count)
+
+        # Test merging into an existing key
+        self.assertTrue(redis_c.pfmerge("myhll1", "myhll2"))
+        self.assertTrue(abs(redis_c.pfcount("myhll1") - 6003) < 6003 * 0.03)
+
+        # Test merging nothing
+        self.assertTrue(redis_c.pfmerge("myempty", "non_existant_key"))
+        self.assertEqual(redis_c.pfcount("myempty"), 0)
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_network_model_latency(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+        network_model = redis_mock.NetworkModel(latencies={"ZRANGE": redis_mock.FixedLatency(0.05)},
+                                                default_latency=0.001, round_trip=0.01)
+        redis_mock.set_network_model(network_model)
+        self.addCleanup(redis_mock.set_network_model, None)
+
+        # Test that each command pays for a round trip and its own latency
+        redis_c.zadd("mykey", "member1", 1)
+        self.assertAlmostEqual(network_model.clock.time(), 0.011)
+        self.assertEqual(redis_c.zrange("mykey", 0, -1), ["member1"])
+        self.assertAlmostEqual(network_model.clock.time(), 0.071)
+
+        # Test that queued commands only pay for the round trip, and EXEC pays for their latency
+        redis_c.execute_command("MULTI")
+        redis_c.zadd("mykey", "member2", 2)
+        redis_c.zrange("mykey", 0, -1)
+        self.assertAlmostEqual(network_model.clock.time(), 0.102)
+        self.assertEqual(redis_c.execute_command("EXEC"), [1, ["member1", "member2"]])
+        self.assertAlmostEqual(network_model.clock.time(), 0.163)
+        self.assertEqual(network_model.round_trips, 6)
+
+        # Test that concurrent threads' round trips overlap, each on its own virtual time
+        network_model = redis_mock.NetworkModel(default_latency=0.1)
+        redis_mock.set_network_model(network_model)
+        thread_times = []
+
+        def run_commands():
+            for i in xrange(10):
+                redis_c.scard("myset")
+            thread_times.append(network_model.clock.time())
+
+        redis_c.scard("myset")
+        threads = [threading.Thread(target=run_commands) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([round(thread_time, 6) for thread_time in thread_times], [1.1] * 4)
+        self.assertAlmostEqual(network_model.clock.time(), 1.1)
+        redis_c.scard("myset")
+        self.assertAlmostEqual(network_model.clock.time(), 1.2)
+
+        # Test that the time spent in a blocking read shows up on the virtual clock
+        network_model = redis_mock.NetworkModel()
+        redis_mock.set_network_model(network_model)
+        self.assertEqual(redis_c.execute_command("XREAD", "BLOCK", 100, "STREAMS", "mystream", "$"), None)
+        self.assertTrue(0.1 <= network_model.clock.time() < 1)
+
+        # Test that simulating hours of latency doesn't take long
+        network_model = redis_mock.NetworkModel(default_latency=redis_mock.NormalLatency(0.1, 0.01), seed=1)
+        redis_mock.set_network_model(network_model)
+        start = time.time()
+        for i in xrange(0, 100000):
+            redis_c.scard("myset")
+        self.assertTrue(abs(network_model.clock.time() - 10000) < 100)
+        self.assertTrue(time.time() - start < 60)
+
+    def test_percentile_latency(self):
+        latency = redis_mock.PercentileLatency({50: 0.001, 99: 0.02, 100: 0.25})
+        rand = random.Random(1)
+        samples = sorted(latency.sample(rand) for i in xrange(0, 10000))
+        self.assertTrue(all(0.001 <= sample <= 0.25 for sample in samples))
+        self.assertEqual(samples[4000], 0.001)
+        self.assertTrue(0.001 < samples[7500] < 0.02)
+        self.assertTrue(samples[-1] > 0.02)
+        self.assertRaises(Exception, redis_mock.PercentileLatency, {})
+        self.assertRaises(Exception, redis_mock.PercentileLatency, {101: 0.1})
+
+    @mock.patch.object(redis.Redis, 'execute_command')
+    def test_network_model_failures(self, mock_execute_command):
+        mock_execute_command.side_effect = redis_mock.execute_command
+        self.addCleanup(redis_mock.set_network_model, None)
+
+        # Test that injected connection errors don't run the command
+        network_model = redis_mock.NetworkModel(connection_error_rate=1.0)
+        redis_mock.set_network_model(network_model)
+        self.assertRaises(redis.exceptions.ConnectionError, redis_c.sadd, "myset", "member1")
+        self.assertEqual(network_model.connection_errors, 1)
+
+        # Test that injected timeouts take the timeout and don't run the command
+        network_model = redis_mock.NetworkModel(timeout=0.5, timeout_rate=1.0)
+        redis_mock.set_network_model(network_model)
+        self.assertRaises(redis.exceptions.TimeoutError, redis_c.sadd, "myset", "member1")
+        self.assertEqual(network_model.timeouts, 1)
+        self.assertEqual(network_model.clock.time(), 0.5)
+        redis_mock.set_network_model(None)
+        self.assertEqual(redis_c.scard("myset"), 0)
+
+        # Test that a command slower than the timeout runs, but still times out
+        network_model = redis_mock.NetworkModel(latencies={"SADD": 2.0}, timeout=0.5)
+        redis_mock.set_network_model(network_model)
+        self.assertRaises(redis.exceptions.TimeoutError, redis_c.sadd, "myset", "member1")
+        self.assertEqual(network_model.timeouts, 1)
+        self.assertEqual(network_model.clock.time(), 0.5)
+        self.assertEqual(redis_c.scard("myset"), 1)
+
+        # Test that an error reply pays for the round trip, and can time out too
+        network_model = redis_mock.NetworkModel(default_latency=1.0)
+        redis_mock.set_network_model(network_model)
+        self.assertRaises(Exception, redis_c.zadd, "myset", "member1", 1)
+        self.assertEqual(network_model.clock.time(), 1.0)
+        network_model = redis_mock.NetworkModel(default_latency=1.0, timeout=0.5)
+        redis_mock.set_network_model(network_model)
+        self.assertRaises(redis.exceptions.TimeoutError, redis_c.zadd, "myset", "member1", 1)
+        self.assertEqual(network_model.clock.time(), 0.5)
+
+        # Test that failures happen at roughly the configured rates
+        network_model = redis_mock.NetworkModel(timeout_rate=0.1, connection_error_rate=0.05, seed=1)
+        redis_mock.set_network_model(network_model)
+        for i in xrange(0, 10000):
+            try:
+                redis_c.scard("myset")
+            except redis.exceptions.RedisError:
+                pass
+        self.assertTrue(abs(network_model.timeouts - 1000) < 150)
+        self.assertTrue(abs(network_model.connection_errors - 500) < 100)
+
+        # Test that a failed round trip discards the transaction and the watched keys, like a dropped connection
+        redis_mock.set_network_model(None)
+        self.assertTrue(redis_c.execute_command("WATCH", "myset"))
+        self.assertTrue(redis_c.execute_command("MULTI"))
+        self.assertEqual(redis_c.sadd("myset", "member2"), "QUEUED")
+        redis_mock.set_network_model(redis_mock.NetworkModel(connection_error_rate=1.0))
+        self.assertRaises(redis.exceptions.ConnectionError, redis_c.execute_command, "EXEC")
+        redis_mock.set_network_model(None)
+        self.assertEqual(redis_c.sadd("myset", "member2"), 1)
+        self.assertRaises(Exception, redis_c.execute_command, "EXEC")
+
+        # Test an optimistic retry loop that keeps failing
+        network_model = redis_mock.NetworkModel(timeout_rate=0.1, connection_error_rate=0.1, seed=1)
+        redis_mock.set_network_model(network_model)
+        num_increments = 200
+        for i in xrange(num_increments):
+            while True:
+                try:
+                    redis_c.execute_command("WATCH", "mykey")
+                    next_score = len(redis_c.zrange("mykey", 0, -1))
+                    redis_c.execute_command("MULTI")
+                    redis_c.zadd("mykey", "member%s" % next_score, next_score)
+                    if redis_c.execute_command("EXEC") is not None:
+                        break
+                except redis.exceptions.RedisError:
+                    pass
+        self.assertTrue(network_model.timeouts + network_model.connection_errors > 100)
+        redis_mock.set_network_model(None)
+        expected_data = [("member%s" % i, i) for i in xrange(num_increments)]
+        self.assertEqual(redis_c.zrange("mykey", 0, -1, withscores=True), expected_data)
+
 if __name__ == "__main__":
     unittest.main()